@@ -1,7 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.shortcuts import render
 
 # Register your models here.
-from .models import MainCategory, BookCategory, SpecialCategory, Book, WishList, UserAccount, CartItem, Checkout, Cart, Comment
+from .models import MainCategory, BookCategory, SpecialCategory, Book, BookPriceHistory, Promotion, WishList, WishListItem, PriceDropNotification, RecentlyViewedBooks, UserAccount, CartItem, Checkout, CheckoutItem, Cart, Comment, UserAccountStats, UserAccountMonthlyStats
+from .forms import RepriceForm
+from services import services
 
 
 class ModelWithoutSlugAdmin(admin.ModelAdmin):
@@ -29,6 +32,26 @@ class BookAdmin(admin.ModelAdmin):
     model = Book
     exclude = ['slug', 'mark', 'wishlist', ]
     inlines = [CommentInline, ]
+    actions = ['reprice_selected_books', ]
+
+    @admin.action(description='Reprice selected books')
+    def reprice_selected_books(self, request, queryset):
+        form = RepriceForm(request.POST if 'apply' in request.POST else None)
+        if form.is_valid():
+            new_prices = services.get_prices_changed_by_percent(
+                queryset.only('id', 'price'), form.cleaned_data['percent'])
+            repriced_count = services.reprice_books(new_prices)
+            self.message_user(request, f'{repriced_count} books repriced', messages.SUCCESS)
+            return None
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Reprice selected books',
+            'opts': self.model._meta,
+            'books': queryset,
+            'form': form,
+            'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        }
+        return render(request, 'admin/bookapp/book/reprice.html', context)
 
 
 class CartItemInline(admin.TabularInline):
@@ -37,17 +60,44 @@ class CartItemInline(admin.TabularInline):
 
 class CartAdmin(admin.ModelAdmin):
     model = Cart
-    fields = ['user', 'is_used']
+    fields = ['user', 'is_used', 'items_count', 'total_qty', 'total_price']
+    readonly_fields = ['items_count', 'total_qty', 'total_price']
     inlines = [CartItemInline, ]
 
 
+class CheckoutItemInline(admin.TabularInline):
+    model = CheckoutItem
+    readonly_fields = ['book', 'title', 'unit_price', 'qty', 'final_price']
+    can_delete = False
+    extra = 0
+
+
+class CheckoutAdmin(admin.ModelAdmin):
+    model = Checkout
+    readonly_fields = ['total_qty', 'total_price']
+    inlines = [CheckoutItemInline, ]
+
+
+class PromotionAdmin(admin.ModelAdmin):
+    model = Promotion
+    list_display = ['title', 'discount_type', 'value', 'book',
+                    'bookcategory', 'specialcategory', 'min_cart_total', 'is_active']
+
+
 admin.site.register(MainCategory, MainCategoryAdmin),
 admin.site.register(BookCategory, BookCategoryAdmin),
 admin.site.register(SpecialCategory, SpecialCategoryAdmin),
 admin.site.register(Book, BookAdmin),
+admin.site.register(BookPriceHistory),
+admin.site.register(Promotion, PromotionAdmin),
 admin.site.register(Cart, CartAdmin),
 admin.site.register(WishList),
+admin.site.register(WishListItem),
+admin.site.register(RecentlyViewedBooks),
+admin.site.register(PriceDropNotification),
 admin.site.register(UserAccount),
 admin.site.register(CartItem),
-admin.site.register(Checkout),
-admin.site.register(Comment)
+admin.site.register(Checkout, CheckoutAdmin),
+admin.site.register(Comment),
+admin.site.register(UserAccountStats),
+admin.site.register(UserAccountMonthlyStats)
@@ -0,0 +1,25 @@
+from django import forms
+from django.conf import settings
+from django.db import models
+from django.template.defaultfilters import filesizeformat
+
+
+class LimitedImageFormField(forms.ImageField):
+    """ Размер файла проверяется до разбора изображения: сверх лимита файл сохранен не полностью """
+
+    def to_python(self, data):
+        if data and data.size > settings.FILE_UPLOAD_MAX_SIZE:
+            raise forms.ValidationError(
+                f'The image must be no larger than {filesizeformat(settings.FILE_UPLOAD_MAX_SIZE)}')
+        return super().to_python(data)
+
+
+class LimitedImageField(models.ImageField):
+    """
+    ImageField, форма которого (в том числе в админке) отклоняет файлы больше FILE_UPLOAD_MAX_SIZE.
+    LimitedTemporaryFileUploadHandler сохраняет от таких файлов только начало,
+    поэтому все ImageField моделей должны быть этого типа
+    """
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{'form_class': LimitedImageFormField, **kwargs})
@@ -1,7 +1,10 @@
 from django import forms
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from django.http import JsonResponse
 
 from .models import SpecialCategory, MainCategory, BookCategory, Book, Cart, UserAccount, Checkout, Comment, User
+from services.avatars import normalize_avatar
 
 import re
 
@@ -33,6 +36,16 @@ class UserAccountForm(FormWithValidator):
         model = UserAccount
         fields = ['image', 'first_name', 'last_name', 'email']
 
+    def clean_image(self):
+        """ Проверяет размер в пикселях по заголовку, затем уменьшает аватар до AVATAR_SIZE """
+        image = self.cleaned_data.get('image')
+        if not isinstance(image, UploadedFile):
+            return image
+        width, height = image.image.size
+        if width * height > settings.AVATAR_MAX_PIXELS:
+            raise forms.ValidationError(f'The image is too large: {width}x{height} pixels')
+        return normalize_avatar(image)
+
 
 class CheckoutForm(FormWithValidator):
 
@@ -82,15 +95,24 @@ class LoginForm(forms.ModelForm):
         fields = ['username', 'password']
 
     def clean(self):
+        """
+        Один запрос за пользователем и одна проверка пароля,
+        после валидации пользователь доступен через get_user() для login без authenticate()
+        """
         username = self.cleaned_data['username']
         password = self.cleaned_data['password']
-        if not User.objects.filter(username=username).exists():
+        user = User.objects.filter(username=username).first()
+        if user is None:
             raise forms.ValidationError(
                 f'There is no user with "{username}" username')
-        else:
-            user = User.objects.get(username=username)
-            if not user.check_password(password):
-                raise forms.ValidationError('Incorrect password')
+        if not user.check_password(password):
+            raise forms.ValidationError('Incorrect password')
+        if not user.is_active:
+            raise forms.ValidationError('This account is inactive')
+        self.user_cache = user
+
+    def get_user(self):
+        return self.user_cache
 
 
 class RegistrForm(forms.ModelForm):
@@ -109,7 +131,7 @@ class RegistrForm(forms.ModelForm):
     def clean_username(self):
         username = self.cleaned_data['username']
         errors = []
-        if User.objects.filter(username=username):
+        if User.objects.filter(username=username).exists():
             errors.append(forms.ValidationError(
                 f'Username "{username}" is already taken'))
         if len(username.strip().split(' ')) > 1:
@@ -121,14 +143,31 @@ class RegistrForm(forms.ModelForm):
 
     def clean_email(self):
         email = self.cleaned_data['email']
-        if UserAccount.objects.filter(email=email):
+        if UserAccount.objects.filter(email=email).exists():
             raise forms.ValidationError(
                 f'User with "{email}" email already exist')
         return email
 
+    def validate_unique(self):
+        # единственное уникальное поле, username, уже проверено в clean_username
+        pass
+
     def clean_confirm_password(self):
         password = self.cleaned_data['password']
         confirm_password = self.cleaned_data['confirm_password']
         if password != confirm_password:
             raise forms.ValidationError('Password isn`t the same')
         return confirm_password
+
+
+class RepriceForm(forms.Form):
+
+    percent = forms.DecimalField(
+        max_digits=5, decimal_places=2,
+        help_text='Price change in percent, e.g. 10 or -15')
+
+    def clean_percent(self):
+        percent = self.cleaned_data['percent']
+        if percent <= -100:
+            raise forms.ValidationError(f'Percent must be greater than -100, you gived: {percent}')
+        return percent
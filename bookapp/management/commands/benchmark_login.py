@@ -0,0 +1,39 @@
+import time
+
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand
+
+from bookapp.forms import LoginForm
+from bookapp.models import User
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест проверки пароля при входе: входов в секунду на одно ядро'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=50)
+
+    def handle(self, *args, **options):
+        logins = options['logins']
+        data = {'username': 'login_benchmark', 'password': 'benchmark password'}
+        user = User.objects.create_user(**data)
+
+        def single_hash_login():
+            form = LoginForm(data)
+            form.is_valid()
+            return form.get_user()
+
+        def double_hash_login():
+            # прежний путь: проверка пароля в форме и еще раз в authenticate()
+            LoginForm(data).is_valid()
+            return authenticate(**data)
+
+        try:
+            for title, login in (('double hash', double_hash_login), ('single hash', single_hash_login)):
+                start = time.perf_counter()
+                for i in range(logins):
+                    login()
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f'{title}: {logins} logins in {elapsed:.2f}s, {logins / elapsed:.1f} logins/s per core')
+        finally:
+            user.delete()
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from bookapp.models import Book, User
+
+
+SESSION_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'bookapp.session_backend',
+)
+
+
+class Command(BaseCommand):
+    help = 'Количество записей в django_session на просмотр страницы для разных SESSION_ENGINE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', type=int, default=50)
+
+    def handle(self, *args, **options):
+        data = {'username': 'session_benchmark', 'password': 'benchmark password'}
+        user = User.objects.create_user(**data)
+        book = Book.objects.create(title='session_benchmark', slug='session-benchmark')
+        urls = [reverse('main_page'), reverse('book_detail', kwargs={'book_slug': book.slug}),
+                reverse('cart_page'), reverse('account_page')]
+        try:
+            for save_every_request in (False, True):
+                for engine in SESSION_ENGINES:
+                    with override_settings(SESSION_ENGINE=engine, SESSION_SAVE_EVERY_REQUEST=save_every_request):
+                        writes = self.count_session_writes(data, urls, options['views'])
+                    self.stdout.write(
+                        f'{engine}, SESSION_SAVE_EVERY_REQUEST={save_every_request}: '
+                        f'{writes} session writes per {options["views"]} page views, '
+                        f'{writes / options["views"]:.2f} per view')
+        finally:
+            user.delete()
+            book.delete()
+
+    def count_session_writes(self, data, urls, views_count):
+        client = Client(SERVER_NAME='localhost')
+        client.post(reverse('login'), data)
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(views_count):
+                client.get(urls[i % len(urls)])
+        return sum(
+            1 for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT INTO "django_session"', 'UPDATE "django_session"')))
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
+
+from bookapp.models import Book, CartItem
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест: параллельные заказы одной книги, проверка остатка и пропускной способности'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--checkouts', type=int, default=200,
+                            help='количество заказов на один поток')
+        parser.add_argument('--stock', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        threads_count = options['threads']
+        checkouts_per_thread = options['checkouts']
+        book = Book.objects.create(
+            title='stock benchmark', info='benchmark', stock=options['stock'])
+        cart_item = CartItem(book=book, qty=1)
+        results = []
+
+        def checkout():
+            try:
+                for i in range(checkouts_per_thread):
+                    while True:
+                        try:
+                            with transaction.atomic():
+                                services.reserve_stock([cart_item])
+                            results.append(True)
+                            break
+                        except services.OutOfStockError:
+                            results.append(False)
+                            break
+                        except OperationalError as e:
+                            if 'locked' not in str(e):
+                                raise
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for i in range(threads_count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        book.refresh_from_db()
+        reserved = results.count(True)
+        book.delete()
+        expected_reserved = min(options['stock'], threads_count * checkouts_per_thread)
+        if reserved != expected_reserved or book.stock != options['stock'] - reserved:
+            raise CommandError(
+                f'Stock is broken: reserved {reserved}, expected {expected_reserved}, stock left {book.stock}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(results)} checkouts ({reserved} reserved, {results.count(False)} out of stock) '
+            f'in {elapsed:.2f}s, {len(results) / elapsed:.0f} checkouts/s, stock left {book.stock}'))
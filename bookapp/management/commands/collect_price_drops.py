@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from services.price_alerts import collect_price_drops
+
+
+class Command(BaseCommand):
+    help = 'Записывает в outbox уведомления о снижении цены книг из вишлистов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        found_count = collect_price_drops(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{found_count} price drops found'))
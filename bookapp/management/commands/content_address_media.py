@@ -0,0 +1,19 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from services.media_migration import content_address_media
+
+
+class Command(BaseCommand):
+    help = 'Переименовывает обложки и аватары по sha256 содержимого, одинаковые файлы сводятся к одному'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-originals', action='store_true',
+                            help='удалить файлы со старыми именами и их рендишены')
+
+    def handle(self, *args, **options):
+        if not hasattr(default_storage, 'get_content_name'):
+            raise CommandError('DEFAULT_FILE_STORAGE must be bookapp.storage.ContentAddressedStorage')
+        counts = content_address_media(options['delete_originals'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{counts["moved"]} files moved, {counts["deduplicated"]} deduplicated, {counts["missing"]} missing'))
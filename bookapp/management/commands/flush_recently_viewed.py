@@ -0,0 +1,17 @@
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from services.recently_viewed import flush_recently_viewed
+
+
+class Command(BaseCommand):
+    help = 'Записывает в базу буферы недавно просмотренных книг, измененные после последней записи'
+
+    def handle(self, *args, **options):
+        if isinstance(caches['default'], LocMemCache):
+            raise CommandError(
+                'Буферы хранятся в памяти процессов сайта, команда их не видит. '
+                'Процессы сайта записывают их сами, для команды нужен общий кеш (CACHE_BACKEND)')
+        flushed_count = flush_recently_viewed()
+        self.stdout.write(self.style.SUCCESS(f'{flushed_count} recently viewed buffers flushed'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Сводит повторяющиеся позиции (корзина, книга) в одну перед миграцией с unique_cart_item_book'
+
+    def handle(self, *args, **options):
+        deleted_count = services.merge_duplicate_cart_items()
+        self.stdout.write(self.style.SUCCESS(f'{deleted_count} duplicate cart items merged'))
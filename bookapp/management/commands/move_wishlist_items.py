@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Переносит вишлисты из устаревшего поля Book.wishlist в таблицу WishListItem'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        moved_count = services.move_legacy_wishlist_books(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{moved_count} wishlist books moved'))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Создает пользователей с аккаунтами, вишлистами и корзинами для нагрузочных тестов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000)
+        parser.add_argument('--prefix', default='loadtest')
+        parser.add_argument('--password', default='loadtest password')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        created_count = services.provision_users(
+            options['count'], options['password'], options['prefix'], options['batch_size'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'{created_count} users provisioned in {elapsed:.2f}s'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику заказов пользователей по всем Checkout'
+
+    def handle(self, *args, **options):
+        accounts_count, months_count = services.rebuild_order_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f'{accounts_count} account stats and {months_count} monthly stats rebuilt'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from services.thumbnail_regeneration import regenerate_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Пересоздает рендишены обложек в пуле процессов, неизмененные изображения пропускаются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='по умолчанию - число ядер')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--force', action='store_true', help='пересоздать все, не сверяясь с манифестом')
+
+    def handle(self, *args, **options):
+        counts, elapsed = regenerate_thumbnails(
+            options['workers'], options['batch_size'], options['force'], progress=self.write_progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'{sum(counts.values())} images in {elapsed:.1f}s: ' + self.format_counts(counts, elapsed)))
+
+    def write_progress(self, counts, elapsed):
+        self.stdout.write(f'{sum(counts.values())} images: {self.format_counts(counts, elapsed)}')
+
+    def format_counts(self, counts, elapsed):
+        rate = sum(counts.values()) / elapsed if elapsed else 0
+        statuses = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+        return f'{statuses} ({rate:.1f} images/s)'
@@ -0,0 +1,44 @@
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookapp.models import Book
+from services import services
+
+
+class Command(BaseCommand):
+    help = (
+        'Массово меняет цены книг и пересчитывает незакрытые корзины. '
+        'Цены берутся из csv файла (slug,price) или меняются на --percent процентов'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', nargs='?')
+        parser.add_argument('--percent', type=Decimal)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['csv_file']:
+            new_prices = self.read_prices(options['csv_file'])
+        elif options['percent'] is not None:
+            new_prices = services.get_prices_changed_by_percent(
+                Book.objects.only('id', 'price'), options['percent'])
+        else:
+            raise CommandError('Pass a csv file or --percent')
+        repriced_count = services.reprice_books(new_prices, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{repriced_count} books repriced'))
+
+    def read_prices(self, path):
+        with open(path, newline='') as csv_file:
+            try:
+                prices_by_slug = {
+                    slug: Decimal(price) for slug, price in csv.reader(csv_file)}
+            except (ValueError, InvalidOperation) as e:
+                raise CommandError(f'Wrong csv row: {e}')
+        book_ids = dict(Book.objects.filter(
+            slug__in=prices_by_slug).values_list('slug', 'id'))
+        unknown_slugs = set(prices_by_slug) - set(book_ids)
+        if unknown_slugs:
+            raise CommandError(f'Unknown books: {", ".join(sorted(unknown_slugs))}')
+        return {book_ids[slug]: price for slug, price in prices_by_slug.items()}
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from services.price_alerts import send_price_drop_notifications
+
+
+class Command(BaseCommand):
+    help = 'Отправляет уведомления о снижении цены из outbox пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        sent_count = send_price_drop_notifications(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{sent_count} notifications sent'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bookapp.models import Checkout
+from services import services
+
+
+class Command(BaseCommand):
+    help = 'Создает снимки позиций для заказов, оформленных до появления CheckoutItem'
+
+    def handle(self, *args, **options):
+        checkouts = Checkout.objects.filter(
+            total_price__isnull=True).select_related('cart')
+        count = 0
+        for checkout in checkouts.iterator():
+            with transaction.atomic():
+                services.create_checkout_snapshot(checkout)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'{count} checkouts snapshotted'))
@@ -0,0 +1,18 @@
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from services.throttling import get_throttled_counts
+
+
+class Command(BaseCommand):
+    help = 'Количество отклоненных throttling запросов по scope'
+
+    def handle(self, *args, **options):
+        if isinstance(caches['default'], LocMemCache):
+            raise CommandError(
+                'Счетчики хранятся в памяти процессов сайта, команда их не видит. '
+                f'Настройте общий кеш (CACHE_BACKEND) или откройте {reverse("throttling_stats")} под staff')
+        for scope, count in get_throttled_counts().items():
+            self.stdout.write(f'{scope}: {count}')
@@ -1,36 +1,48 @@
 from django.views import View
 from django.views.generic.base import ContextMixin
+from django.http import HttpResponse, JsonResponse
+from django.contrib import messages
+from django.db.models import Count, Prefetch
 
-from .models import MainCategory, BookCategory, Book, SpecialCategory, WishList, Cart, UserAccount
+from .models import MainCategory, BookCategory
 from django.conf import settings
 
 from django.contrib.auth.mixins import LoginRequiredMixin
 
+from services.anonymous_cart import AnonymousCart
+from services.carts import apply_current_discount
+from services.shopping_context import load_shopping_context
+from services.throttling import get_blocking_scope, get_retry_after
+
 
 class UserMixin(ContextMixin, View):
 
     def dispatch(self, request, *args, **kwargs):
         self.user = request.user
         if self.user.is_authenticated:
-            self.wishlist, wishlist_created = WishList.objects.get_or_create(
-                user=self.user
-            )
-            self.cart, cart_created = Cart.objects.get_or_create(
-                user=self.user, is_used=False
-            )
-            self.account, account_created = UserAccount.objects.get_or_create(
-                user=self.user
-            )
-        
-        return super().dispatch(request, *args, **kwargs)
+            self.account, self.wishlist, self.cart = load_shopping_context(request)
+            apply_current_discount(self.cart)
+        else:
+            self.cart = AnonymousCart.from_request(request)
+
+        response = super().dispatch(request, *args, **kwargs)
+        if not self.user.is_authenticated:
+            self.cart.save(response)
+        return response
 
     def get_context_data(self, **kwargs):
+        """
+        Значения контекста ленивые: queryset и методы (шаблон вызывает их сам)
+        обращаются к базе только если шаблон их использует
+        """
         context = super().get_context_data(**kwargs)
-        context['main_categorys'] = MainCategory.objects.all()
+        context['main_categorys'] = MainCategory.objects.prefetch_related(Prefetch(
+            'bookcategories', queryset=BookCategory.objects.annotate(books_count=Count('books'))))
+        context['cart'] = self.cart
+        context['cart_final_price'] = self.cart.get_cart_result('final_price')
         if self.user.is_authenticated:
             context['wishlist'] = self.wishlist.books.all()
-            context['cart'] = self.cart.cart_items.all()
-            context['cart_final_price'] = self.cart.get_cart_result('final_price')
+            context['wishlist_count'] = self.wishlist.get_items_count
         return context
     
 
@@ -38,3 +50,61 @@ class MyLoginRequiredMixin(LoginRequiredMixin):
 
     login_url = settings.LOGIN_URL
 
+    def handle_no_permission(self):
+        if self.request.is_ajax():
+            return JsonResponse({'status': 'login_required', 'login_url': self.login_url}, status=401)
+        return super().handle_no_permission()
+
+
+class ThrottleMixin:
+    """
+    Отклоняет запрос с 429 до любой работы с базой и хеширования пароля.
+    Должен стоять в MRO перед UserMixin
+    """
+
+    throttle_scope = None
+    throttle_methods = ('get', 'post')
+    # поле POST, по которому ведется отдельный бакет на пользователя
+    throttle_username_field = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method.lower() in self.throttle_methods:
+            username = request.POST.get(self.throttle_username_field) if self.throttle_username_field else None
+            blocking_bucket = get_blocking_scope(request, self.throttle_scope, username)
+            if blocking_bucket:
+                return self.throttled_responce(request, *blocking_bucket)
+        return super().dispatch(request, *args, **kwargs)
+
+    def throttled_responce(self, request, blocking_scope, ident):
+        if request.is_ajax():
+            response = JsonResponse({'status': 'throttled'}, status=429)
+        else:
+            response = HttpResponse('Too many requests, try again later', status=429)
+        response['Retry-After'] = get_retry_after(blocking_scope, ident)
+        return response
+
+
+class JsonSummaryMixin:
+    """
+    POST выполняет то же действие, что и GET.
+    На AJAX запрос вместо редиректа и рендера страницы отдает итоги корзины и вишлиста
+    """
+
+    def post(self, request, *args, **kwargs):
+        response = self.get(request, *args, **kwargs)
+        if request.is_ajax():
+            return self.summary_json_responce(request)
+        return response
+
+    def summary_json_responce(self, request):
+        return JsonResponse({'good': True,
+            'messages': [str(message) for message in messages.get_messages(request)],
+            'cart_info': {
+                'items_count': self.cart.items_count,
+                'total_qty': self.cart.total_qty,
+                'final_price': f'{self.cart.get_cart_result("final_price"):.2f}',
+            },
+            'wishlist_info': {
+                'count': self.wishlist.get_items_count() if self.user.is_authenticated else 0,
+            }}, status=200)
+
@@ -1,16 +1,50 @@
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
 from django.utils.text import slugify
 from django.urls import reverse
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.dispatch import Signal
 
 from random import random
 
+from .fields import LimitedImageField
+
 User = get_user_model()
 
 
+# Доступные сортировки книг: ключ из GET-параметра ?sort= -> ordering.
+# Каждая сортировка заканчивается уникальным id, поэтому порядок детерминирован
+# и по нему можно делать keyset (cursor) пагинацию.
+BOOK_SORTINGS = {
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'mark': ('-mark', '-id'),
+    'newest': ('-id', ),
+    'title': ('title', 'id'),
+}
+
+
+DEFAULT_BOOK_IMAGE = 'default_book_image.jpg'
+DEFAULT_AVATAR = 'default_avatar.jpg'
+
+
+def get_default_image_name(name):
+    """ Изображение по умолчанию под именем по содержимому, если хранилище так именует файлы """
+    get_file_content_name = getattr(default_storage, 'get_file_content_name', None)
+    return get_file_content_name(name) if get_file_content_name else name
+
+
+def get_default_book_image():
+    return get_default_image_name(DEFAULT_BOOK_IMAGE)
+
+
+def get_default_avatar():
+    return get_default_image_name(DEFAULT_AVATAR)
+
+
 def create_slug(title):
     slug = str(slugify(title)) + '-' + str(int(random() * 100000))
     return slug
@@ -57,7 +91,10 @@ class BookCategory(Category):
         return reverse('bookcategory_page', kwargs={'bookcategory_slug': self.slug})
 
     def get_books_count(self):
-        return len(self.books.all())
+        # books_count аннотируется в UserMixin, чтобы не считать книги запросом на категорию
+        if hasattr(self, 'books_count'):
+            return self.books_count
+        return self.books.count()
 
 
 class WishList(models.Model):
@@ -65,51 +102,86 @@ class WishList(models.Model):
 
     user = models.ForeignKey(User, related_name='wishlist',
                              on_delete=models.CASCADE, blank=True, null=True)
+    books = models.ManyToManyField(
+        'Book', through='WishListItem', related_name='wishlists', blank=True)
+    # Денормализованное количество книг, меняется вместе с WishListItem (bookapp.signals)
+    items_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'WishList: {self.user.username}, {self.id}'
 
+    def get_items_count(self):
+        """ Счетчик для шапки, вишлист из UserMixin загружен только по id """
+        return WishList.objects.filter(id=self.id).values_list('items_count', flat=True).first() or 0
+
 
 class Book(models.Model):
     """ Модель Книги """
 
     title = models.CharField(max_length=40)
-    image = models.ImageField(default='default_book_image.jpg')
+    image = LimitedImageField(default=get_default_book_image)
     slug = models.SlugField(unique=True, blank=True)
     info = models.TextField(max_length=300)
     price = models.DecimalField(max_digits=5, decimal_places=2, default=50.00)
     mark = models.DecimalField(
-        max_digits=3, decimal_places=2, blank=True, null=True, default=0)
+        max_digits=3, decimal_places=2, blank=True, default=0)
+    # None - остаток не ведется (книги, заведенные до учета остатков), такие книги не списываются
+    stock = models.PositiveIntegerField(null=True, blank=True)
 
     bookcategories = models.ManyToManyField(
         BookCategory, related_name='books', blank=True)
     specialcategories = models.ManyToManyField(
         SpecialCategory, related_name='books', blank=True)
+    # Устаревшая связь: книга могла быть только в одном вишлисте.
+    # Данные переносятся в WishListItem командой move_wishlist_items, затем поле будет удалено
     wishlist = models.ForeignKey(
-        WishList, related_name='books', on_delete=models.SET_NULL, blank=True, null=True)
+        WishList, related_name='legacy_books', on_delete=models.SET_NULL, blank=True, null=True)
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            models.Index(fields=['price', 'id'], name='book_price_id_idx'),
+            models.Index(fields=['-mark', '-id'], name='book_mark_id_idx'),
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # имя изображения при загрузке из базы, по нему save узнает о новой обложке
+        self._loaded_image_name = str(self.__dict__.get('image') or '')
 
     def save(self, *args, **kwargs):
+        from services.thumbnails import refresh_thumbnails
+
         if not self.slug:
             self.slug = create_slug(self.title)
         if not self.image:
-            self.image = "default_book_image.jpg"
+            self.image = get_default_book_image()
         if self.comments.all().exists():
             self.mark = self.get_average_book_mark_value()
         else:
             self.mark = 0
+        image_changed = 'image' in self.__dict__ and (
+            not self.image._committed or self.image.name != self._loaded_image_name)
         super().save(*args, **kwargs)
+        if image_changed:
+            refresh_thumbnails(self.image)
+            self._loaded_image_name = self.image.name
 
     def get_absolute_url(self):
         return reverse('book_detail', kwargs={'book_slug': self.slug})
 
-    def get_book_count_in_cart(self, cart):
-        queryset = cart.cart_items.filter(book__slug=self.slug)
-        if queryset.exists():
-            return queryset[0].qty
-        return 0
+    def get_price_at(self, moment):
+        """ Цена книги на момент moment по истории изменения цены """
+        last_change = self.price_history.filter(
+            date_of_change__lte=moment).order_by('-date_of_change').first()
+        if last_change:
+            return last_change.price
+        next_change = self.price_history.filter(
+            date_of_change__gt=moment).order_by('date_of_change').first()
+        if next_change:
+            return next_change.old_price
+        return self.price
 
     def get_average_book_mark_value(self):
         if not self.comments.all().exists():
@@ -123,6 +195,146 @@ class Book(models.Model):
         return self.title
 
 
+class WishListItem(models.Model):
+    """ Книга в вишлисте, уникальный индекс (wishlist, book) используется для проверки наличия """
+
+    wishlist = models.ForeignKey(
+        WishList, related_name='items', on_delete=models.CASCADE)
+    book = models.ForeignKey(
+        Book, related_name='wishlist_items', on_delete=models.CASCADE)
+    date_added = models.DateTimeField(auto_now_add=True)
+    price_added = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['wishlist', 'book'], name='unique_wishlist_item_book'),
+        ]
+
+    def __str__(self):
+        return f'{self.wishlist_id}: {self.book_id}'
+
+
+class ThumbnailSource(models.Model):
+    """
+    Манифест regenerate_thumbnails: состояние оригинала и размеры, с которыми созданы его рендишены.
+    name - имя файла в хранилище, failed - оригинал с таким хешем не удалось разобрать
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    source_hash = models.CharField(max_length=32)
+    source_size = models.PositiveBigIntegerField()
+    source_mtime = models.FloatField()
+    failed = models.BooleanField(default=False)
+    spec_hash = models.CharField(max_length=8)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class PriceDropNotification(models.Model):
+    """
+    Outbox уведомлений о снижении цены книги из вишлиста.
+    Уникальность (user, book, new_price) не дает повторно уведомить о той же цене
+    """
+
+    user = models.ForeignKey(
+        User, related_name='price_drop_notifications', on_delete=models.CASCADE)
+    book = models.ForeignKey(
+        Book, related_name='price_drop_notifications', on_delete=models.CASCADE)
+    old_price = models.DecimalField(max_digits=5, decimal_places=2)
+    new_price = models.DecimalField(max_digits=5, decimal_places=2)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book', 'new_price'],
+                                    name='unique_price_drop_notification'),
+        ]
+        indexes = [
+            models.Index(fields=['date_sent', 'id'], name='price_drop_outbox_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}: {self.book_id} {self.old_price} -> {self.new_price}'
+
+
+class RecentlyViewedBooks(models.Model):
+    """ Сохраненный буфер последних просмотренных книг пользователя, порядок - от новых к старым """
+
+    user = models.OneToOneField(
+        User, related_name='recently_viewed_books', on_delete=models.CASCADE)
+    book_ids = models.JSONField(default=list)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user_id}: {self.book_ids}'
+
+
+class BookPriceHistory(models.Model):
+    """ История изменения цены книги """
+
+    book = models.ForeignKey(
+        Book, related_name='price_history', on_delete=models.CASCADE)
+    old_price = models.DecimalField(max_digits=5, decimal_places=2)
+    price = models.DecimalField(max_digits=5, decimal_places=2)
+    date_of_change = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', '-date_of_change'],
+                         name='book_price_history_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id}: {self.old_price} -> {self.price}'
+
+
+class Promotion(models.Model):
+    """
+    Скидка в процентах или фиксированной суммой (на единицу товара).
+    Действует на книгу, книжную или специальную категорию,
+    а если ни одна из них не указана - на всю корзину от суммы min_cart_total
+    """
+
+    PERCENT = 'percent'
+    FIXED = 'fixed'
+    DISCOUNT_TYPES = [
+        (PERCENT, 'Percent'),
+        (FIXED, 'Fixed amount'),
+    ]
+
+    title = models.CharField(max_length=255)
+    discount_type = models.CharField(
+        max_length=10, choices=DISCOUNT_TYPES, default=PERCENT)
+    value = models.DecimalField(max_digits=7, decimal_places=2)
+    book = models.ForeignKey(
+        Book, related_name='promotions', on_delete=models.CASCADE, blank=True, null=True)
+    bookcategory = models.ForeignKey(
+        BookCategory, related_name='promotions', on_delete=models.CASCADE, blank=True, null=True)
+    specialcategory = models.ForeignKey(
+        SpecialCategory, related_name='promotions', on_delete=models.CASCADE, blank=True, null=True)
+    min_cart_total = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.title
+
+    def clean(self):
+        scopes = [self.book_id, self.bookcategory_id, self.specialcategory_id]
+        if len([scope for scope in scopes if scope]) > 1:
+            raise ValidationError(
+                'Promotion can be scoped by only one of book, book category or special category')
+
+
+# Позиция корзины сохранена через CartItem.save, получатель пересчитывает итоги
+# корзины (bookapp.signals). Массовые UPDATE пересчитывают итоги сами, удаления
+# любым способом ловит post_delete
+cart_items_changed = Signal()
+
+
 class Cart(models.Model):
     """ Модель корзины пользователя """
 
@@ -130,14 +342,25 @@ class Cart(models.Model):
                              on_delete=models.CASCADE)
     is_used = models.BooleanField(default=False)
 
+    # Денормализованные итоги корзины, пересчитываются при изменении CartItem (services.carts)
+    items_count = models.PositiveIntegerField(default=0)
+    total_qty = models.PositiveIntegerField(default=0)
+    total_price = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+    discount = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+    # Версия правил скидок, по которым посчитан discount
+    promotions_version = models.CharField(max_length=32, blank=True)
+
     def __str__(self):
         return f'{self.user.username}`s cart, is_used = {self.is_used}'
 
     def get_cart_result(self, param):
-        if not self.cart_items.exists():
-            return 0
-        final_param = self.cart_items.aggregate(Sum(param))
-        return round(final_param[param+'__sum'], 2)
+        summary_fields = {
+            'final_price': self.total_price - self.discount,
+            'qty': self.total_qty,
+        }
+        return summary_fields[param]
 
 
 class CartItem(models.Model):
@@ -151,12 +374,24 @@ class CartItem(models.Model):
     cart = models.ForeignKey(
         Cart, related_name='cart_items', on_delete=models.CASCADE, null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['cart', 'book'], name='unique_cart_item_book'),
+        ]
+
     def __str__(self):
         return self.book.title
 
     def save(self, *args, **kwargs):
         self.final_price = self.book.price * self.qty
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'final_price' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'final_price']
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.cart_id:
+                cart_items_changed.send(sender=CartItem, cart=self.cart)
 
 
 class UserAccount(models.Model):
@@ -164,7 +399,7 @@ class UserAccount(models.Model):
 
     user = models.OneToOneField(
         User, related_name='account', on_delete=models.CASCADE)
-    image = models.ImageField(upload_to="user/", null=True, blank=True)
+    image = LimitedImageField(upload_to="user/", null=True, blank=True)
     first_name = models.CharField(max_length=255, null=True, blank=True)
     last_name = models.CharField(max_length=255, null=True, blank=True)
     email = models.EmailField(null=True, blank=True)
@@ -174,7 +409,7 @@ class UserAccount(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.image:
-            self.image = 'default_avatar.jpg'
+            self.image = get_default_avatar()
         super().save(*args, **kwargs)
 
 
@@ -195,11 +430,85 @@ class Checkout(models.Model):
         auto_now_add=True, blank=True, null=True)
     date_of_change = models.DateField(auto_now=True, blank=True, null=True)
 
+    # Зафиксированные на момент заказа итоги, null - заказ оформлен до появления снимков
+    total_qty = models.PositiveIntegerField(null=True, blank=True)
+    total_price = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True)
+    discount = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_account', '-id'],
+                         name='checkout_account_id_idx'),
+        ]
+
     def __str__(self):
         return f'{self.user_account.first_name}`s checkout'
 
     def get_fullprice(self):
-        return self.cart.get_cart_result('final_price')
+        if self.total_price is None:
+            return self.cart.get_cart_result('final_price')
+        return self.total_price
+
+
+class CheckoutItem(models.Model):
+    """ Неизменяемый снимок позиции заказа """
+
+    checkout = models.ForeignKey(
+        Checkout, related_name='items', on_delete=models.CASCADE)
+    book = models.ForeignKey(
+        Book, related_name='checkout_items', on_delete=models.SET_NULL, blank=True, null=True)
+    title = models.CharField(max_length=40)
+    unit_price = models.DecimalField(max_digits=5, decimal_places=2)
+    qty = models.PositiveIntegerField()
+    final_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f'{self.title} x {self.qty}'
+
+
+class UserAccountStats(models.Model):
+    """ Накопительная статистика заказов пользователя """
+
+    user_account = models.OneToOneField(
+        UserAccount, related_name='stats', on_delete=models.CASCADE)
+    orders_count = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0)
+    last_order_date = models.DateField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.user_account}`s stats'
+
+    def get_average_basket(self):
+        if not self.orders_count:
+            return 0
+        return round(self.total_spent / self.orders_count, 2)
+
+
+class UserAccountMonthlyStats(models.Model):
+    """ Статистика заказов пользователя за месяц """
+
+    user_account = models.ForeignKey(
+        UserAccount, related_name='monthly_stats', on_delete=models.CASCADE)
+    month = models.DateField()
+    orders_count = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-month']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_account', 'month'], name='unique_account_month_stats'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_account}`s stats for {self.month:%Y-%m}'
 
 
 class Comment(models.Model):
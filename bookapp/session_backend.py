@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+
+KEY_PREFIX = 'bookapp.session_backend'
+
+
+class SessionStore(cached_db.SessionStore):
+    """
+    Сессии читаются из кеша, а в базу пишутся только если изменились данные
+    или срок хранения в базе отстал от нового больше чем на SESSION_EXPIRY_REFRESH_THRESHOLD секунд.
+    В кеше рядом с данными лежит срок хранения, записанный в базу
+    """
+
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._saved_state = None
+        super().__init__(session_key)
+
+    def load(self):
+        try:
+            cached = self._cache.get(self.cache_key)
+        except Exception:
+            # как в cached_db: некоторые кеши падают на невалидном ключе
+            cached = None
+
+        if cached is None:
+            s = self._get_session_from_db()
+            if s is None:
+                return {}
+            cached = {'data': self.decode(s.session_data), 'expire_date': s.expire_date}
+            self._cache.set(self.cache_key, cached, self.get_expiry_age(expiry=s.expire_date))
+        self._saved_state = (self.serializer().dumps(cached['data']), cached['expire_date'])
+        return cached['data']
+
+    def needs_write(self):
+        if self._saved_state is None:
+            return True
+        saved_data, saved_expire_date = self._saved_state
+        if saved_data != self.serializer().dumps(self._session):
+            return True
+        threshold = timedelta(seconds=settings.SESSION_EXPIRY_REFRESH_THRESHOLD)
+        return self.get_expiry_date() - saved_expire_date > threshold
+
+    def save(self, must_create=False):
+        if not must_create and self.session_key and not self.needs_write():
+            return
+        # запись в базу без cached_db.save, кеш обновляем в своем формате
+        DBStore.save(self, must_create)
+        expire_date = self.get_expiry_date()
+        self._cache.set(self.cache_key, {'data': self._session, 'expire_date': expire_date}, self.get_expiry_age())
+        self._saved_state = (self.serializer().dumps(self._session), expire_date)
@@ -0,0 +1,57 @@
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from services.carts import recalc_cart_summary, recalc_cart_totals
+from services.promotions import bump_promotions_version
+
+from .models import CartItem, Promotion, WishList, WishListItem, cart_items_changed
+
+
+@receiver([post_save, post_delete], sender=Promotion)
+def promotion_changed(sender, instance, **kwargs):
+    bump_promotions_version()
+
+
+@receiver(cart_items_changed)
+def cart_items_changed_handler(sender, cart, **kwargs):
+    recalc_cart_summary(cart)
+
+
+# CartItem.delete, каскадное удаление книги и QuerySet.delete в админке
+@receiver(post_delete, sender=CartItem)
+def cart_item_deleted(sender, instance, **kwargs):
+    if instance.cart_id:
+        recalc_cart_totals(instance.cart_id)
+
+
+def change_wishlists_items_count(wishlist_ids, delta):
+    wishlists = WishList.objects.filter(id__in=wishlist_ids)
+    if delta < 0:
+        wishlists = wishlists.filter(items_count__gte=-delta)
+    wishlists.update(items_count=F('items_count') + delta)
+
+
+# WishList.items_count меняется вместе с WishListItem при любом способе изменения:
+# create/delete, каскадное удаление книги и books.add/remove/clear
+@receiver(post_save, sender=WishListItem)
+def wishlist_item_saved(sender, instance, created, **kwargs):
+    if created:
+        change_wishlists_items_count([instance.wishlist_id], 1)
+
+
+@receiver(post_delete, sender=WishListItem)
+def wishlist_item_deleted(sender, instance, **kwargs):
+    change_wishlists_items_count([instance.wishlist_id], -1)
+
+
+@receiver(m2m_changed, sender=WishList.books.through)
+def wishlist_books_added(sender, instance, action, reverse, pk_set, **kwargs):
+    # add() создает строки через bulk_create без post_save, remove() и clear() удаляют
+    # через QuerySet.delete и попадают в post_delete
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        change_wishlists_items_count(pk_set, 1)
+    else:
+        change_wishlists_items_count([instance.id], len(pk_set))
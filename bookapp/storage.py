@@ -0,0 +1,94 @@
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.views.static import serve
+
+import hashlib
+import os
+import posixpath
+import re
+
+
+CONTENT_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+# Производный файл от файла с именем по содержимому: суффикс и хеш параметров,
+# с которыми он создан (рендишен: ab/ab12...ef.jpg.card.1a2b3c4d.jpg)
+DERIVED_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{64}\.\w+\.\w+\.[0-9a-f]{8}\.\w+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def is_content_name(name):
+    return bool(CONTENT_NAME_RE.search(name))
+
+
+def is_immutable_name(name):
+    return is_content_name(name) or bool(DERIVED_NAME_RE.search(name))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Файлы сохраняются под именем из sha256 содержимого: upload_to/ab/ab12...ef.jpg.
+    Одинаковые загрузки ссылаются на один файл, а файл под таким именем никогда не меняется,
+    поэтому его URL можно кешировать как immutable.
+    Производные файлы (рендишены) пишутся под своими именами через save_derived,
+    хеш параметров в их имени делает и эти имена неизменяемыми
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._file_content_names = {}
+
+    def get_content_name(self, name, content):
+        sha256 = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        content.seek(0)
+        digest = sha256.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), digest[:2], f'{digest}{extension}')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        content_name = self.get_content_name(name, content)
+        if self.exists(content_name):
+            return content_name
+        # параллельная загрузка того же файла может успеть между exists и записью,
+        # тогда обычный save добавил бы к имени суффикс. Содержимое у них одинаковое,
+        # поэтому файл просто заменяется
+        return self.save_replacing(content_name, content, max_length)
+
+    def save_derived(self, name, content):
+        """ Сохраняет файл под именем name, заменяя прежний """
+        return self.save_replacing(name, content)
+
+    def save_replacing(self, name, content, max_length=None):
+        """ Пишет во временный файл рядом и атомарно переименовывает его в name """
+        tmp_name = super().save(f'{name}.tmp', content, max_length)
+        os.replace(self.path(tmp_name), self.path(name))
+        return name
+
+    def get_file_content_name(self, name):
+        """
+        Имя по содержимому для файла, который уже лежит в хранилище под обычным именем
+        (изображения по умолчанию). Копия создается при первом обращении, если ее нет
+        """
+        key = (self.location, name)
+        if key not in self._file_content_names:
+            if is_content_name(name) or not self.exists(name):
+                return name
+            with self.open(name) as content:
+                self._file_content_names[key] = self.save(name, content)
+        return self._file_content_names[key]
+
+
+def serve_media(request, path, document_root=None):
+    """
+    static.serve для DEBUG, файлы с именем по содержимому и их рендишены
+    отдаются с Cache-Control: immutable
+    """
+    response = serve(request, path, document_root=document_root)
+    if is_immutable_name(path):
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
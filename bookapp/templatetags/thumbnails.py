@@ -0,0 +1,25 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html
+
+from services.thumbnails import get_thumbnails
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def thumbnail(image, size, css_class='', alt=''):
+    """
+    <img> с рендишеном size, srcset для retina и размытой заглушкой в фоне до загрузки.
+    {% thumbnail book.image 'card' css_class='book_image_django' %}
+    """
+    thumbnails = get_thumbnails(image)
+    if thumbnails is None:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="lazy">', image.url, css_class, alt)
+    retina_url = thumbnails['urls'][f'{size}_{settings.THUMBNAIL_RETINA_SCALE}x']
+    url = thumbnails['urls'][size]
+    return format_html(
+        '<img src="{}" srcset="{} 1x, {} {}x" class="{}" alt="{}" loading="lazy" decoding="async" '
+        'style="background: url({}) center / cover no-repeat">',
+        url, url, retina_url, settings.THUMBNAIL_RETINA_SCALE, css_class, alt, thumbnails['placeholder'])
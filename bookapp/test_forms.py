@@ -1,10 +1,23 @@
 from bookapp.models import User, UserAccount
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.contrib.auth.hashers import MD5PasswordHasher, make_password
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 
 from datetime import date, timedelta
+import io
 import json
+from unittest import addModuleCleanup
+
+from PIL import Image
 
 from .forms import CommentForm, FormWithValidator, CheckoutForm, LoginForm, RegistrForm, UserAccountForm
+from .test_services import use_temporary_media_root
+
+
+def setUpModule():
+    addModuleCleanup(use_temporary_media_root())
 
 
 class ServicesFuncTestCase(TestCase):
@@ -37,6 +50,47 @@ class UserAccountFormTestCase(TestCase):
         self.assertEqual(invalid_form.errors['__all__'], ['"test test" must be one word string'])
 
 
+class UserAccountFormAvatarTestCase(TestCase):
+
+    def create_upload(self, size=(2000, 1500), image_format='JPEG', **save_options):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, image_format, **save_options)
+        return SimpleUploadedFile(f'avatar.{image_format.lower()}', buffer.getvalue())
+
+    def get_form(self, upload):
+        return UserAccountForm(data={'first_name': 'test'}, files={'image': upload})
+
+    def test_avatar_is_normalized_without_metadata(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: повернуть на 90 градусов
+        exif[0x010f] = 'Camera'
+        form = self.get_form(self.create_upload(size=(2000, 1000), exif=exif))
+        self.assertTrue(form.is_valid())
+        avatar = form.cleaned_data['image']
+        self.assertEqual(avatar.name, 'avatar.jpg')
+        with Image.open(avatar) as image:
+            self.assertEqual(image.size, (256, 256))
+            self.assertNotIn('exif', image.info)
+
+    def test_small_avatar_is_not_upscaled(self):
+        form = self.get_form(self.create_upload(size=(100, 50), image_format='PNG'))
+        self.assertTrue(form.is_valid())
+        with Image.open(form.cleaned_data['image']) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (50, 50)))
+
+    @override_settings(FILE_UPLOAD_MAX_SIZE=1000)
+    def test_file_size_limit(self):
+        form = self.get_form(self.create_upload())
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['image'], ['The image must be no larger than 1000\xa0bytes'])
+
+    @override_settings(AVATAR_MAX_PIXELS=1000 * 1000)
+    def test_pixel_limit(self):
+        form = self.get_form(self.create_upload())
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['image'], ['The image is too large: 2000x1500 pixels'])
+
+
 class CheckoutFromTestData(TestCase):
 
     def test_clean_method(self):
@@ -241,3 +295,40 @@ class RegistrFormTestCase(TestCase):
 
 
 
+
+
+class CountingPasswordHasher(MD5PasswordHasher):
+
+    verify_calls = 0
+
+    def verify(self, password, encoded):
+        CountingPasswordHasher.verify_calls += 1
+        return super().verify(password, encoded)
+
+
+class LoginPasswordHashingTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user(username='user', password='123456')
+
+    @override_settings(PASSWORD_HASHERS=['bookapp.test_forms.CountingPasswordHasher'])
+    def test_login_verifies_password_once(self):
+        User.objects.filter(username='user').update(password=make_password('123456'))
+        CountingPasswordHasher.verify_calls = 0
+        r = self.client.post(reverse('login'), {'username': 'user', 'password': '123456'})
+        self.assertRedirects(r, reverse('main_page'))
+        self.assertEqual(CountingPasswordHasher.verify_calls, 1)
+
+    def test_password_is_rehashed_with_new_iterations(self):
+        with self.settings(PASSWORD_HASHER_ITERATIONS=1000):
+            form = LoginForm({'username': 'user', 'password': '123456'})
+            self.assertTrue(form.is_valid())
+        password = User.objects.get(username='user').password
+        self.assertTrue(password.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(form.get_user().check_password('123456'))
+
+    def test_inactive_user(self):
+        User.objects.filter(username='user').update(is_active=False)
+        form = LoginForm({'username': 'user', 'password': '123456'})
+        self.assertFalse(form.is_valid())
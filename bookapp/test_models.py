@@ -5,13 +5,20 @@ from django.urls import reverse
 from decimal import *
 import sys
 import os
+from unittest import addModuleCleanup
 
-from .models import Book, Cart, CartItem, SpecialCategory, MainCategory, BookCategory, User, UserAccount, WishList, Comment, Checkout
+from .models import Book, Cart, CartItem, SpecialCategory, MainCategory, BookCategory, User, UserAccount, WishList, Comment, Checkout, get_default_avatar, get_default_book_image
+from .storage import is_content_name
+from .test_services import use_temporary_media_root
 
 
 sys.path.append('..')
 
 
+def setUpModule():
+    addModuleCleanup(use_temporary_media_root())
+
+
 class CategoryTest(TestCase):
 
     def setUp(self):
@@ -100,6 +107,45 @@ class CartTestCase(TestCase):
         cart_final_qty = self.cart.get_cart_result('qty')
         self.assertEqual(cart_final_qty, 1)
 
+    def test_summary_columns_follow_cart_items(self):
+        book = Book.objects.create(title='title', price=Decimal('10.00'))
+        another_book = Book.objects.create(title='title1', price=Decimal('5.00'))
+        cart_item = CartItem.objects.create(book=book, qty=2, cart=self.cart)
+        CartItem.objects.create(book=another_book, qty=1, cart=self.cart)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.items_count, 2)
+        self.assertEqual(self.cart.total_qty, 3)
+        self.assertEqual(self.cart.total_price, Decimal('25.00'))
+
+        cart_item.qty = 4
+        cart_item.save(update_fields=['qty'])
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_qty, 5)
+        self.assertEqual(self.cart.total_price, Decimal('45.00'))
+
+        cart_item.delete()
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.items_count, 1)
+        self.assertEqual(self.cart.total_qty, 1)
+        self.assertEqual(self.cart.total_price, Decimal('5.00'))
+
+    def test_summary_columns_follow_cascade_and_queryset_delete(self):
+        book = Book.objects.create(title='title', price=Decimal('10.00'))
+        another_book = Book.objects.create(title='title1', price=Decimal('5.00'))
+        CartItem.objects.create(book=book, qty=2, cart=self.cart)
+        CartItem.objects.create(book=another_book, qty=1, cart=self.cart)
+        book.delete()
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.items_count, 1)
+        self.assertEqual(self.cart.total_qty, 1)
+        self.assertEqual(self.cart.total_price, Decimal('5.00'))
+
+        CartItem.objects.filter(cart=self.cart).delete()
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.items_count, 0)
+        self.assertEqual(self.cart.total_qty, 0)
+        self.assertEqual(self.cart.total_price, 0)
+
 
 class CartItemTestCase(TestCase):
 
@@ -122,6 +168,8 @@ class CartItemTestCase(TestCase):
         self.cart_item.qty = 2
         self.cart_item.save(update_fields=['qty'])
         self.assertEqual(self.cart_item.final_price, Decimal(200.00))
+        self.cart_item.refresh_from_db()
+        self.assertEqual(self.cart_item.final_price, Decimal(200.00))
 
     def test_book_on_delete(self):
         self.book.delete()
@@ -156,7 +204,8 @@ class UserAccountTestCase(TestCase):
         )
 
     def test_default_image(self):
-        self.assertEqual(self.user_acc.image, 'default_avatar.jpg')
+        self.assertEqual(self.user_acc.image, get_default_avatar())
+        self.assertTrue(is_content_name(self.user_acc.image.name))
 
     def test_user_on_delete(self):
         self.assertEqual(self.user, self.user_acc.user)
@@ -167,11 +216,10 @@ class UserAccountTestCase(TestCase):
         with open('test_images/book1.png', 'rb') as image:
             new_image = File(image)
             self.user_acc.image.save('new_image.png', new_image)
-            self.assertEqual(self.user_acc.image.name, 'user/new_image.png')
-            os.remove('media/user/new_image.png')
+            self.assertRegex(self.user_acc.image.name, r'^user/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
             self.user_acc.image = None
             self.user_acc.save(update_fields=['image'])
-            self.assertEqual(self.user_acc.image.name, 'default_avatar.jpg')
+            self.assertEqual(self.user_acc.image.name, get_default_avatar())
 
 
 class BookTestCase(TestCase):
@@ -226,24 +274,12 @@ class BookTestCase(TestCase):
         book.save()
         self.assertNotEquals(book.slug, '')
         self.assertEqual(book.mark, 0)
-        self.assertEqual(book.image.name, 'default_book_image.jpg')
+        self.assertEqual(book.image.name, get_default_book_image())
 
     def test_get_absolute_url(self):
         self.assertEqual(self.book.get_absolute_url(), reverse(
             'book_detail', kwargs={'book_slug': self.book.slug}))
 
-    def test_get_book_count_in_cart(self):
-        cart = Cart.objects.create(
-            user=User.objects.create(username='user', password='123456')
-        )
-        self.assertEqual(self.book.get_book_count_in_cart(cart), 0)
-        cart_item = CartItem.objects.create(
-            book=self.book,
-            qty=2,
-            cart=cart
-        )
-        self.assertEqual(self.book.get_book_count_in_cart(cart), 2)
-
     def test_get_average_book_mark_value(self):
         user_acc = UserAccount.objects.create(
             user=User.objects.create(username='user', password='123456')
@@ -351,6 +387,13 @@ class CheckoutTestCase(TestCase):
             )
         self.assertEqual(self.checkout.get_fullprice(), Decimal('250.00'))
 
+    def test_get_fullprice_uses_frozen_total(self):
+        CartItem.objects.create(
+            book=Book.objects.get(id=1), qty=1, cart=self.cart)
+        self.checkout.total_price = Decimal('80.00')
+        self.checkout.save(update_fields=['total_price'])
+        self.assertEqual(self.checkout.get_fullprice(), Decimal('80.00'))
+
     def test_set_and_delete_cart(self):
         another_cart = Cart.objects.last()
         self.checkout.cart = another_cart 
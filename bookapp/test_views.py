@@ -1,15 +1,33 @@
 from django.http import response
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.cache import cache
 from django.urls.base import reverse
 from django.http.response import JsonResponse
 from django.contrib.messages import get_messages
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib import admin
 
 import json
+import os
+import tempfile
+import threading
 from datetime import date, timedelta
+from io import StringIO
+from unittest import addModuleCleanup, mock
 
-from .models import Book, BookCategory, CartItem, Comment, SpecialCategory, User, UserAccount, WishList
+from .models import Book, BookCategory, MainCategory, Cart, CartItem, Checkout, Comment, RecentlyViewedBooks, SpecialCategory, User, UserAccount, WishList
 from .views import AccountView, AddToCart, AddToWishList, BookCategoryDetail, BookComments, BookDetail, CheckoutsHistoryView, DeleteFromWishList, MainPage, RemoveFromCart
-from .test_services import get_messages_from_storage
+from .test_services import get_messages_from_storage, use_temporary_media_root
+from .upload_handlers import LimitedTemporaryFileUploadHandler
+from services.services import create_checkout_snapshot
+from services.memberships import get_memberships_key, invalidate_memberships
+from services.recently_viewed import RECENTLY_VIEWED_FLUSH_LOCK_KEY, RECENTLY_VIEWED_SIZE, flush_recently_viewed
+from services.throttling import get_retry_after, get_throttled_counts, take_token
+
+
+def setUpModule():
+    addModuleCleanup(use_temporary_media_root())
 
 
 class MainPageViewTestCase(TestCase):
@@ -73,6 +91,14 @@ class MainPageViewTestCase(TestCase):
         self.assertFalse(r.context['is_it_special'])
         self.assertIsNone(r.context['special_category'])
 
+    def test_sorting(self):
+        r = self.client.get(self.url + '?sort=price')
+        self.assertEqual(r.context['sort'], 'price')
+        self.assertEqual(list(r.context['page_obj']),
+                         list(Book.objects.order_by('price', 'id')[:4]))
+        last_book = r.context['page_obj'].object_list[-1]
+        self.assertContains(r, f'?sort=price&after={last_book.id}')
+
     def test_context_with_special_category_slug(self):
         r = self.client.get('/main_page/sp_slug/')
         special_category = SpecialCategory.objects.get(slug='sp_slug')
@@ -81,6 +107,36 @@ class MainPageViewTestCase(TestCase):
         self.assertEqual(r.context['special_category'], special_category)
 
 
+class LazyContextTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user(username='user', password='123456')
+
+    def create_categories(self, start, stop):
+        for i in range(start, stop):
+            main_category = MainCategory.objects.create(title=f'main{i}', slug=f'main{i}')
+            bookcategory = BookCategory.objects.create(
+                title=f'category{i}', slug=f'category{i}', main_category=main_category)
+            Book.objects.create(title=f'title{i}', slug=f'slug{i}').bookcategories.add(bookcategory)
+
+    def test_sidebar_queries_do_not_grow_with_categories(self):
+        self.create_categories(0, 1)
+        with self.assertNumQueries(5):
+            r = self.client.get(reverse('main_page'))
+        self.create_categories(1, 6)
+        with self.assertNumQueries(5):
+            self.client.get(reverse('main_page'))
+        self.assertContains(r, 'category0 (1)')
+
+    def test_unused_context_is_not_queried(self):
+        self.client.login(username='user', password='123456')
+        self.client.get(reverse('account_page'))
+        with self.assertNumQueries(4):
+            r = self.client.get(reverse('account_page'))
+        self.assertTrue(callable(r.context['wishlist_count']))
+
+
 class BookDetailViewTestCase(TestCase):
 
     @classmethod
@@ -179,6 +235,19 @@ class BookCategoryDetailViewTestCase(TestCase):
         self.assertIn('is_paginated', r_next_page.context)
         self.assertEqual(len(r_next_page.context['books']), 2)
 
+    def test_sorting_with_cursor(self):
+        books = list(Book.objects.order_by('title', 'id'))
+        r = self.client.get(self.url + f'?sort=title&after={books[9].id}')
+        self.assertEqual(r.context['sort'], 'title')
+        self.assertEqual(list(r.context['books']), books[10:])
+
+    def test_sorting_emits_next_cursor_link(self):
+        books = list(Book.objects.order_by('title', 'id'))
+        r = self.client.get(self.url + '?sort=title')
+        self.assertEqual(r.context['next_cursor'], books[9].id)
+        self.assertContains(r, f'?sort=title&after={books[9].id}')
+        self.assertNotContains(r, '?page=2')
+
 
 class AddAndDeleteFromWishListViewTestCase(TestCase):
 
@@ -253,11 +322,14 @@ class AddAndRemoveFromCartViewTestCase(TestCase):
     def test_reverse_without_login(self):
         r_add = self.client.get(self.add_url)
         self.assertEqual(r_add.status_code, 302)
-        self.assertRedirects(r_add, '/login/?next=/add_to_cart/slug/')
+        self.assertRedirects(r_add, reverse('book_detail', kwargs={'book_slug': 'slug'}))
+        self.assertIn('cart', r_add.cookies)
+        self.assertFalse(CartItem.objects.exists())
 
         r_remove = self.client.get(self.remove_url)
         self.assertEqual(r_remove.status_code, 302)
-        self.assertRedirects(r_remove, '/login/?next=/remove_from_cart/1/')
+        self.assertRedirects(r_remove, reverse('cart_page'))
+        self.assertEqual(r_remove.cookies['cart'].value, '')
 
 
 class WishListViewTestCase(TestCase):
@@ -311,10 +383,12 @@ class CartViewTestCase(TestCase):
     def test_reverse_and_url_without_login(self):
         r = self.client.get('/account_page/cart_page/')
         r_reverse = self.client.get(self.url)
-        self.assertEqual(r.status_code, 302)
-        self.assertEqual(r_reverse.status_code, 302)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r_reverse.status_code, 200)
+
+    def test_checkout_without_login(self):
+        r = self.client.post(self.url)
         self.assertRedirects(r, '/login/?next=/account_page/cart_page/')
-        self.assertRedirects(r_reverse, '/login/?next=/account_page/cart_page/')
 
     def test_template(self):
         self.client.login(username='user', password='123456')
@@ -328,6 +402,16 @@ class CartViewTestCase(TestCase):
         self.assertIn('cart_products', r.context)
         self.assertIn('checkout_form', r.context)
 
+    def test_header_and_totals_read_cart_summary(self):
+        self.client.login(username='user', password='123456')
+        Book.objects.create(title='title', slug='slug', price=20)
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        r = self.client.get(self.url)
+        self.assertEqual(r.context['cart_final_qty'], 2)
+        self.assertEqual(r.context['cart_final_price'], 40)
+        self.assertContains(r, '(1 items)')
+
     def test_post_with_invalid_form(self):
         self.client.login(username='user', password='123456')
         invalid_data = {
@@ -360,6 +444,24 @@ class CartViewTestCase(TestCase):
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0], 'You have succesfully placed an order')
 
+    def test_post_with_out_of_stock_book(self):
+        self.client.login(username='user', password='123456')
+        self.client.get(self.url)
+        cart = User.objects.get(username='user').carts.get(is_used=False)
+        CartItem.objects.create(book=Book.objects.create(title='title', stock=1), qty=2, cart=cart)
+        valid_data = {
+            'first_name': 'test_name',
+            'last_name': 'test_lastname',
+            'email': 'test@test.com',
+            'address': 'test address',
+            'delivery_date': date.today() + timedelta(days=1)
+        }
+        r = self.client.post(self.url, valid_data)
+        self.assertRedirects(r, reverse('cart_page'))
+        messages = get_messages_from_storage(get_messages(r.wsgi_request))
+        self.assertEqual(messages, ['Sorry, there are not enough "title" books in stock'])
+        self.assertFalse(Checkout.objects.exists())
+
 
 class RecalcCartView(TestCase):
 
@@ -381,7 +483,7 @@ class RecalcCartView(TestCase):
     def test_url_without_login(self):
         r = self.client.post(self.url)
         self.assertEqual(r.status_code, 302)
-        self.assertRedirects(r, '/login/?next=/account_page/cart_page/recalt_cart/')
+        self.assertRedirects(r, reverse('cart_page'))
     
     def test_post_with_invalid_data(self):
         invalid_data = {
@@ -391,6 +493,26 @@ class RecalcCartView(TestCase):
         r = self.client.post(self.url, invalid_data)
         self.assertEqual(r.status_code, 404)
 
+    def test_ajax_post_returns_cart_totals(self):
+        self.client.login(username='user', password='123456')
+        self.client.get(reverse('cart_page'))
+        user = User.objects.get(username='user')
+        cart = user.carts.get(is_used=False)
+        cart_item = CartItem.objects.create(
+            book=Book.objects.create(title='title', price=10), cart=cart)
+        r = self.client.post(self.url, {str(cart_item.id): 4}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 200)
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['cart_info'], {
+            'items_count': 1, 'total_qty': 4, 'total_price': '40.00',
+            'discount': '0.00', 'final_price': '40.00'})
+
+    def test_ajax_post_with_invalid_qty(self):
+        self.client.login(username='user', password='123456')
+        r = self.client.post(self.url, {'1': 'a'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(json.loads(r.content)['status'], 'form_invalid')
+
 
 class AccountViewTestCase(TestCase):
 
@@ -423,6 +545,7 @@ class AccountViewTestCase(TestCase):
         r = self.client.get(self.url)
         self.assertIn('form', r.context)
         self.assertIn('account', r.context)
+        self.assertIn('account_stats', r.context)
 
     def test_post_with_valid_form(self):
         valid_data = {
@@ -477,6 +600,24 @@ class CheckoutsHistoryViewTestCase(TestCase):
         self.assertTemplateUsed(r, 'bookapp/account_page/checkouts.html')         
         self.assertIn('checkouts', r.context)
 
+    def test_history_queries_do_not_grow_with_checkouts(self):
+        self.client.login(username='user', password='123456')
+        self.client.get(self.url)
+        account = UserAccount.objects.get(user__username='user')
+        book = Book.objects.create(title='title', price=10)
+        for i in range(12):
+            cart = Cart.objects.create(user=account.user, is_used=True)
+            CartItem.objects.create(book=book, qty=i + 1, cart=cart)
+            checkout = Checkout.objects.create(
+                cart=cart, user_account=account, first_name='name', last_name='name')
+            create_checkout_snapshot(checkout)
+        # session, user, wishlist, cart, account, count, header wishlist, checkouts, items
+        with self.assertNumQueries(6):
+            r = self.client.get(self.url)
+        self.assertEqual(len(r.context['checkouts']), 10)
+        self.assertTrue(r.context['is_paginated'])
+        self.assertContains(r, 'qty: 12')
+
 
 class BookCommentsTestCase(TestCase):
 
@@ -519,3 +660,447 @@ class BookCommentsTestCase(TestCase):
  
 
 
+class BookAdminRepriceActionTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser(username='admin', password='123456')
+        cls.book = Book.objects.create(title='title', price=10)
+        cls.url = reverse('admin:bookapp_book_changelist')
+
+    def test_reprice_action(self):
+        self.client.login(username='admin', password='123456')
+        data = {'action': 'reprice_selected_books', '_selected_action': [self.book.id]}
+        r = self.client.post(self.url, data)
+        self.assertTemplateUsed(r, 'admin/bookapp/book/reprice.html')
+        r = self.client.post(self.url, {**data, 'apply': 'Reprice', 'percent': '50'})
+        self.assertRedirects(r, self.url)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.price, 15)
+
+
+class AnonymousCartTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='title', slug='slug', price=10)
+        cls.other_book = Book.objects.create(title='other', slug='other', price=5)
+        User.objects.create_user(username='user', password='123456')
+
+    def test_cart_without_database_rows(self):
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'other'}))
+        self.assertFalse(Cart.objects.exists())
+
+        r = self.client.get(reverse('cart_page'))
+        self.assertEqual(r.context['cart_final_qty'], 3)
+        self.assertEqual(r.context['cart_final_price'], 25)
+        self.assertEqual(len(r.context['cart_products']), 2)
+
+    def test_recalc_without_login(self):
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'other'}))
+        data = {str(self.book.id): 4, str(self.other_book.id): 0}
+        r = self.client.post(reverse('recalc_cart'), data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        cart_info = json.loads(r.content)['cart_info']
+        self.assertEqual(cart_info['items_count'], 1)
+        self.assertEqual(cart_info['final_price'], '40.00')
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['cart'] = '{"1": [100, "0"]}'
+        r = self.client.get(reverse('cart_page'))
+        self.assertEqual(r.context['cart_final_qty'], 0)
+
+    def test_merge_on_login(self):
+        user = User.objects.get(username='user')
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, book=self.book, final_price=10)
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'other'}))
+
+        r = self.client.post(reverse('login'), {'username': 'user', 'password': '123456'})
+        self.assertRedirects(r, reverse('main_page'))
+        self.assertEqual(r.cookies['cart'].value, '')
+        cart.refresh_from_db()
+        self.assertEqual(cart.items_count, 2)
+        self.assertEqual(cart.total_qty, 3)
+        self.assertEqual(cart.total_price, 25)
+
+    def test_merge_keeps_qty_of_concurrently_added_book(self):
+        user = User.objects.get(username='user')
+        cart = Cart.objects.create(user=user)
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'other'}))
+        bulk_update = CartItem.objects.bulk_update
+
+        def bulk_update_before_concurrent_insert(objs, *args, **kwargs):
+            # параллельный запрос добавил ту же книгу между чтением корзины и вставкой
+            CartItem.objects.bulk_create([CartItem(cart=cart, book=self.book, qty=2, final_price=20)])
+            return bulk_update(objs, *args, **kwargs)
+
+        with mock.patch.object(CartItem.objects, 'bulk_update', bulk_update_before_concurrent_insert):
+            self.client.post(reverse('login'), {'username': 'user', 'password': '123456'})
+        self.assertEqual(CartItem.objects.get(cart=cart, book=self.book).qty, 3)
+        self.assertEqual(CartItem.objects.get(cart=cart, book=self.other_book).qty, 1)
+        cart.refresh_from_db()
+        self.assertEqual(cart.total_qty, 4)
+
+    def test_merge_on_registration(self):
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        data = {'username': 'new_user', 'email': 'new@mail.com',
+                'password': '123456', 'confirm_password': '123456'}
+        r = self.client.post(reverse('registration'), data)
+        self.assertRedirects(r, reverse('main_page'))
+        cart = Cart.objects.get(user__username='new_user', is_used=False)
+        self.assertEqual(cart.total_qty, 1)
+
+
+class JsonSummaryEndpointsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='title', slug='slug', price=10)
+        User.objects.create_user(username='user', password='123456')
+
+    def post_ajax(self, url):
+        return self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_add_and_remove_from_cart(self):
+        self.client.login(username='user', password='123456')
+        r = self.post_ajax(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.assertTrue(isinstance(r, JsonResponse))
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['messages'], ['Book added to cart'])
+        self.assertEqual(json_data['cart_info'], {'items_count': 1, 'total_qty': 1, 'final_price': '10.00'})
+
+        cart_item = CartItem.objects.get()
+        r = self.post_ajax(reverse('remove_from_cart', kwargs={'id': cart_item.id}))
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['cart_info'], {'items_count': 0, 'total_qty': 0, 'final_price': '0.00'})
+
+    def test_add_to_cart_without_login(self):
+        r = self.post_ajax(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['cart_info']['total_qty'], 1)
+        self.assertIn('cart', r.cookies)
+
+    def test_add_and_remove_from_wishlist(self):
+        self.client.login(username='user', password='123456')
+        r = self.post_ajax(reverse('add_to_wishlist', kwargs={'book_slug': 'slug'}))
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['messages'], ['Added to wish list'])
+        self.assertEqual(json_data['wishlist_info']['count'], 1)
+
+        r = self.post_ajax(reverse('remove_from_wishlist', kwargs={'book_slug': 'slug'}))
+        self.assertEqual(json.loads(r.content)['wishlist_info']['count'], 0)
+
+    def test_wishlist_without_login(self):
+        r = self.post_ajax(reverse('add_to_wishlist', kwargs={'book_slug': 'slug'}))
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(json.loads(r.content)['status'], 'login_required')
+
+    def test_post_without_ajax_redirects(self):
+        self.client.login(username='user', password='123456')
+        r = self.client.post(reverse('add_to_cart', kwargs={'book_slug': 'slug'}))
+        self.assertRedirects(r, reverse('book_detail', kwargs={'book_slug': 'slug'}))
+
+
+@override_settings(THROTTLE_RATES={'login': (3, 60), 'login_username': (2, 60), 'cart': (2, 60)})
+class ThrottlingTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.create(title='title', slug='slug')
+        User.objects.create_user(username='user', password='123456')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_add_to_cart_is_throttled_per_ip(self):
+        url = reverse('add_to_cart', kwargs={'book_slug': 'slug'})
+        self.client.get(url)
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            r = self.client.get(url)
+        self.assertEqual(r.status_code, 429)
+        self.assertTrue(int(r['Retry-After']) > 0)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.1').status_code, 302)
+        self.assertEqual(get_throttled_counts()['cart'], 1)
+
+    def test_login_is_throttled_per_username(self):
+        data = {'username': 'user', 'password': 'wrong'}
+        self.client.post(reverse('login'), data)
+        self.client.post(reverse('login'), data, REMOTE_ADDR='10.0.0.1')
+        r = self.client.post(reverse('login'), data, REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(get_throttled_counts()['login_username'], 1)
+
+    @override_settings(THROTTLE_RATES={'login': (10, 600), 'login_username': (2, 10)})
+    def test_retry_after_uses_blocking_scope(self):
+        data = {'username': 'user', 'password': 'wrong'}
+        for i in range(2):
+            self.client.post(reverse('login'), data)
+        r = self.client.post(reverse('login'), data)
+        self.assertEqual(r.status_code, 429)
+        # окно username в 10 секунд освобождается не позже чем через 10 + 10 / 2
+        self.assertTrue(0 < int(r['Retry-After']) <= 15)
+
+    @override_settings(THROTTLE_RATES={'cart': (5, 60)})
+    def test_window_boundary_does_not_double_the_limit(self):
+        with mock.patch('services.throttling.time.time', return_value=6000 + 59):
+            self.assertEqual([take_token('cart', 'ip') for i in range(6)], [True] * 5 + [False])
+        # 58 секунд предыдущего окна еще в последней минуте: 5 * 58 / 60 + 1 > 5
+        with mock.patch('services.throttling.time.time', return_value=6000 + 61):
+            self.assertFalse(take_token('cart', 'ip'))
+        # к середине окна вес предыдущего уменьшился: 5 * 30 / 60 + 1 <= 5
+        with mock.patch('services.throttling.time.time', return_value=6000 + 90):
+            self.assertTrue(take_token('cart', 'ip'))
+
+    @override_settings(THROTTLE_RATES={'cart': (5, 60)})
+    def test_retry_after_waits_for_previous_window_weight(self):
+        with mock.patch('services.throttling.time.time', return_value=6000 + 59):
+            for i in range(5):
+                take_token('cart', 'ip')
+        with mock.patch('services.throttling.time.time', return_value=6000 + 61):
+            self.assertFalse(take_token('cart', 'ip'))
+            retry_after = get_retry_after('cart', 'ip')
+        # отклоненный запрос не считается: 5 * (60 - t) / 60 + 1 <= 5 при t >= 12
+        self.assertEqual(retry_after, 11)
+        with mock.patch('services.throttling.time.time', return_value=6000 + 61 + retry_after):
+            self.assertTrue(take_token('cart', 'ip'))
+
+    def test_throttling_stats_view_is_staff_only(self):
+        url = reverse('add_to_cart', kwargs={'book_slug': 'slug'})
+        for i in range(3):
+            self.client.get(url)
+        r = self.client.get(reverse('throttling_stats'))
+        self.assertEqual(r.status_code, 302)
+        User.objects.create_user(username='staff', password='123456', is_staff=True)
+        self.client.login(username='staff', password='123456')
+        r = self.client.get(reverse('throttling_stats'))
+        self.assertEqual(json.loads(r.content)['cart'], 1)
+        with self.assertRaises(CommandError):
+            call_command('throttling_stats', stdout=StringIO())
+
+    @override_settings(THROTTLE_RATES={'cart': (50, 600)})
+    def test_take_token_does_not_overadmit_concurrent_requests(self):
+        results = []
+
+        def hit():
+            for i in range(20):
+                results.append(take_token('cart', '127.0.0.1'))
+
+        threads = [threading.Thread(target=hit) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 50)
+
+    def test_login_page_get_is_not_throttled(self):
+        for i in range(5):
+            self.assertEqual(self.client.get(reverse('login')).status_code, 200)
+
+    def test_throttled_ajax_request(self):
+        url = reverse('add_to_cart', kwargs={'book_slug': 'slug'})
+        for i in range(2):
+            self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        r = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(json.loads(r.content)['status'], 'throttled')
+
+
+class MembershipBadgesTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = BookCategory.objects.create(title='category', slug='category')
+        for i in range(3):
+            Book.objects.create(title=f'title{i}', slug=f'slug{i}', price=10).bookcategories.add(category)
+        User.objects.create_user(username='user', password='123456')
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='user', password='123456')
+
+    def test_badges_on_book_cards(self):
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug0'}))
+        self.client.get(reverse('add_to_cart', kwargs={'book_slug': 'slug0'}))
+        self.client.get(reverse('add_to_wishlist', kwargs={'book_slug': 'slug1'}))
+        for url in (reverse('main_page'), reverse('bookcategory_page', kwargs={'bookcategory_slug': 'category'})):
+            r = self.client.get(url)
+            books = {book.slug: book for book in r.context['page_obj']}
+            self.assertEqual(books['slug0'].count_in_cart, 2)
+            self.assertFalse(books['slug0'].is_on_wishlist)
+            self.assertTrue(books['slug1'].is_on_wishlist)
+            self.assertEqual(books['slug2'].count_in_cart, 0)
+            self.assertContains(r, 'in cart: 2')
+            self.assertContains(r, 'in wishlist')
+
+    def test_badge_queries_do_not_grow_with_cards(self):
+        self.client.get(reverse('add_to_wishlist', kwargs={'book_slug': 'slug1'}))
+        self.client.get(reverse('main_page'))
+        with self.assertNumQueries(7):
+            self.client.get(reverse('main_page'))
+        for i in range(3, 6):
+            Book.objects.create(title=f'title{i}', slug=f'slug{i}')
+        self.client.get(reverse('add_to_wishlist', kwargs={'book_slug': 'slug4'}))
+        self.client.get(reverse('main_page'))
+        with self.assertNumQueries(7):
+            self.client.get(reverse('main_page'))
+
+    def test_memberships_invalidated_on_change(self):
+        self.client.get(reverse('main_page'))
+        self.client.get(reverse('add_to_wishlist', kwargs={'book_slug': 'slug2'}))
+        r = self.client.get(reverse('main_page'))
+        self.assertTrue({book.slug: book for book in r.context['page_obj']}['slug2'].is_on_wishlist)
+        self.client.get(reverse('remove_from_wishlist', kwargs={'book_slug': 'slug2'}))
+        r = self.client.get(reverse('main_page'))
+        self.assertFalse({book.slug: book for book in r.context['page_obj']}['slug2'].is_on_wishlist)
+
+    def test_memberships_invalidated_after_commit(self):
+        user = User.objects.get(username='user')
+        key = get_memberships_key(user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_memberships(user.id)
+            # параллельный запрос успел закешировать состояние до коммита
+            cache.set(key, {'cart_id': None, 'cart': {}, 'wishlist': set()})
+        self.assertIsNone(cache.get(key))
+
+
+class RecentlyViewedTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = [Book.objects.create(title=f'title{i}', slug=f'slug{i}') for i in range(RECENTLY_VIEWED_SIZE + 2)]
+        User.objects.create_user(username='user', password='123456')
+
+    def setUp(self):
+        cache.clear()
+
+    def view(self, book):
+        return self.client.get(reverse('book_detail', kwargs={'book_slug': book.slug}))
+
+    def test_anonymous_buffer_in_cookie(self):
+        for book in self.books[:3]:
+            self.view(book)
+        r = self.view(self.books[0])
+        self.assertEqual(r.context['recently_viewed_books'], [self.books[2], self.books[1]])
+        self.assertIn('recently_viewed', r.cookies)
+        self.assertContains(r, 'Recently viewed')
+
+    def test_buffer_is_capped(self):
+        for book in self.books:
+            self.view(book)
+        r = self.view(self.books[-1])
+        self.assertEqual(r.context['recently_viewed_books'], self.books[-2:-RECENTLY_VIEWED_SIZE - 1:-1])
+
+    def test_user_views_are_not_written_on_every_hit(self):
+        self.client.login(username='user', password='123456')
+        for book in self.books[:3]:
+            self.view(book)
+        # записан только первый просмотр, остальные ждут интервала или flush_recently_viewed
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids, [self.books[0].id])
+        r = self.view(self.books[3])
+        self.assertEqual(r.context['recently_viewed_books'], self.books[2::-1])
+
+    def test_pending_views_are_flushed_by_next_view(self):
+        self.client.login(username='user', password='123456')
+        for book in self.books[:3]:
+            self.view(book)
+        self.client.logout()
+        self.view(self.books[0])
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids, [self.books[0].id])
+        # интервал прошел: просмотр другого посетителя дописывает отложенный буфер
+        cache.delete(RECENTLY_VIEWED_FLUSH_LOCK_KEY)
+        self.view(self.books[0])
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids, [book.id for book in self.books[2::-1]])
+
+    def test_command_refuses_process_local_cache(self):
+        with self.assertRaises(CommandError):
+            call_command('flush_recently_viewed', stdout=StringIO())
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'bookapp_test_cache')}})
+    def test_pending_views_are_flushed_by_command(self):
+        cache.clear()
+        self.client.login(username='user', password='123456')
+        for book in self.books[:3]:
+            self.view(book)
+        out = StringIO()
+        call_command('flush_recently_viewed', stdout=out)
+        self.assertIn('1 recently viewed buffers flushed', out.getvalue())
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids, [book.id for book in self.books[2::-1]])
+        # очередь пуста, пока нет новых просмотров
+        call_command('flush_recently_viewed', stdout=out)
+        self.assertIn('0 recently viewed buffers flushed', out.getvalue())
+        self.view(self.books[3])
+        self.assertEqual(flush_recently_viewed(), 1)
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids[0], self.books[3].id)
+
+    @override_settings(RECENTLY_VIEWED_FLUSH_INTERVAL=0)
+    def test_user_buffer_is_flushed_and_restored(self):
+        self.client.login(username='user', password='123456')
+        for book in self.books[:3]:
+            self.view(book)
+        self.assertEqual(RecentlyViewedBooks.objects.get().book_ids, [book.id for book in self.books[2::-1]])
+        cache.clear()
+        self.client.login(username='user', password='123456')
+        r = self.view(self.books[3])
+        self.assertEqual(r.context['recently_viewed_books'], self.books[2::-1])
+
+
+class AvatarUploadTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='123456')
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        override = override_settings(MEDIA_ROOT=media_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client.login(username='user', password='123456')
+
+    def post_avatar(self):
+        with open('test_images/book2.jpg', 'rb') as image:
+            return self.client.post(reverse('account_page'), {'first_name': 'test', 'image': image})
+
+    def test_avatar_is_stored_normalized(self):
+        self.assertRedirects(self.post_avatar(), reverse('account_page'))
+        account = UserAccount.objects.get(user=self.user)
+        self.assertRegex(account.image.name, r'^user/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual((account.image.width, account.image.height), (256, 256))
+
+    @override_settings(FILE_UPLOAD_MAX_SIZE=10 * 1024)
+    def test_too_large_upload_is_not_stored(self):
+        r = self.post_avatar()
+        self.assertEqual(r.status_code, 200)
+        self.assertContains(r, 'The image must be no larger than')
+        self.assertEqual(UserAccount.objects.get(user=self.user).image.name, 'default_avatar.jpg')
+
+    def test_upload_handler_discards_data_over_limit(self):
+        handler = LimitedTemporaryFileUploadHandler()
+        handler.new_file('image', 'avatar.jpg', 'image/jpeg', None)
+        with override_settings(FILE_UPLOAD_MAX_SIZE=10):
+            handler.receive_data_chunk(b'x' * 8, 0)
+            handler.receive_data_chunk(b'x' * 8, 8)
+        uploaded_file = handler.file_complete(16)
+        self.assertEqual(uploaded_file.size, 16)
+        self.assertEqual(os.path.getsize(uploaded_file.temporary_file_path()), 8)
+        uploaded_file.close()
+
+    @override_settings(FILE_UPLOAD_MAX_SIZE=10 * 1024)
+    def test_admin_book_form_rejects_too_large_image(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.create_superuser(username='admin', password='123456')
+        form_class = admin.site._registry[Book].get_form(request)
+        with open('test_images/book2.jpg', 'rb') as image:
+            upload = SimpleUploadedFile('book.jpg', image.read(), content_type='image/jpeg')
+        form = form_class({'title': 'title', 'info': 'info', 'price': 10}, {'image': upload})
+        self.assertFalse(form.is_valid())
+        self.assertIn('The image must be no larger than', form.errors['image'][0])
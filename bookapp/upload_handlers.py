@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    Загрузка всегда пишется на диск кусками, целиком в памяти файл не держится.
+    Данные сверх FILE_UPLOAD_MAX_SIZE дочитываются из запроса, но не сохраняются;
+    size у файла остается полным, и форма поля LimitedImageField (bookapp.fields) отклоняет его по размеру
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received_size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received_size += len(raw_data)
+        if self.received_size > settings.FILE_UPLOAD_MAX_SIZE:
+            return None
+        return super().receive_data_chunk(raw_data, start)
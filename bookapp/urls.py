@@ -26,4 +26,6 @@ urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('registration/', RegistrationView.as_view(), name='registration'),
     path('logout/', logout_view, name='logout'),
+
+    path('throttling_stats/', throttling_stats_view, name='throttling_stats'),
 ]
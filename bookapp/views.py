@@ -5,7 +5,10 @@ from django.views.generic import ListView, DetailView
 from django.shortcuts import redirect, reverse, get_object_or_404
 from django.http import JsonResponse
 from django.db.models import Q
+from django.db import IntegrityError
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth.views import redirect_to_login
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.utils.safestring import mark_safe
 from django.conf import settings
@@ -15,8 +18,10 @@ import sys
 
 from .models import MainCategory, BookCategory, Book, SpecialCategory, WishList, Cart, CartItem, UserAccount
 from .forms import UserAccountForm, CheckoutForm, CommentForm, LoginForm, RegistrForm
-from .mixins import UserMixin, MyLoginRequiredMixin
+from .mixins import UserMixin, MyLoginRequiredMixin, JsonSummaryMixin, ThrottleMixin
 from services import services
+from services.recently_viewed import RecentlyViewed, flush_recently_viewed_if_due
+from services.throttling import get_throttled_counts
 
 
 sys.path.append('..')
@@ -42,8 +47,16 @@ class MainPage(UserMixin, ListView):
         services.get_queryset_for_main_page(self, special_category_slug)
         return super().dispatch(request, *args, **kwargs)
 
+    def get_queryset(self):
+        return services.get_sorted_books_queryset(self, super().get_queryset())
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['page_obj'].object_list = services.annotate_books_memberships(
+            self, context['page_obj'].object_list)
+        context['sort'] = self.sort
+        context['cursor'] = self.cursor
+        context['next_cursor'] = services.get_next_cursor(self, context['page_obj'])
         context['special_categorys'] = SpecialCategory.objects.all()
         context['is_it_special'] = self.is_it_special
         context['special_category'] = self.special_category
@@ -70,14 +83,26 @@ class BookDetail(UserMixin, DetailView):
         self.object = self.get_object()
         return super().dispatch(request, *args, **kwargs)
 
+    def get(self, request, *args, **kwargs):
+        self.recently_viewed = RecentlyViewed.from_request(request)
+        # книга уже загружена в dispatch, DetailView.get загрузил бы ее повторно
+        response = self.render_to_response(self.get_context_data(object=self.object))
+        self.recently_viewed.push(self.object.id)
+        self.recently_viewed.save(response)
+        flush_recently_viewed_if_due()
+        return response
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         if self.user.is_authenticated:
-            context['is_book_on_wishlist'] = services.is_book_on_wishlist(self)
-            context['count_in_cart'] = self.object.get_book_count_in_cart(self.cart)
+            memberships = services.get_book_memberships(self)
+            context['is_book_on_wishlist'] = self.object.id in memberships['wishlist']
+            context['count_in_cart'] = memberships['cart'].get(self.object.id, 0)
         context['comments'] = services.get_book_comments(self)
         context['comment_form'] = CommentForm()
         context['you_may_also_like_books'] = services.get_also_like_books_queryset(self)
+        if hasattr(self, 'recently_viewed'):
+            context['recently_viewed_books'] = self.recently_viewed.get_books(exclude_id=self.object.id)
         return context
 
 
@@ -93,15 +118,24 @@ class BookCategoryDetail(UserMixin, ListView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
-        return self.bookcategory.books.all().order_by('-id')
+        return services.get_sorted_books_queryset(
+            self, self.bookcategory.books.all(), default_ordering=('-id', ))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['page_obj'].object_list = services.annotate_books_memberships(
+            self, context['page_obj'].object_list)
+        context['books'] = context['page_obj'].object_list
+        context['sort'] = self.sort
+        context['cursor'] = self.cursor
+        context['next_cursor'] = services.get_next_cursor(self, context['page_obj'])
         context['category_title'] = self.bookcategory.title
         return context
 
 
-class AddToWishList(MyLoginRequiredMixin, UserMixin):
+class AddToWishList(ThrottleMixin, MyLoginRequiredMixin, JsonSummaryMixin, UserMixin):
+
+    throttle_scope = 'cart'
 
     def get(self, request, *args, **kwargs):
         book_slug = kwargs.get('book_slug')
@@ -109,7 +143,9 @@ class AddToWishList(MyLoginRequiredMixin, UserMixin):
         return redirect('book_detail', book_slug=book_slug)
 
 
-class DeleteFromWishList(MyLoginRequiredMixin, UserMixin):
+class DeleteFromWishList(ThrottleMixin, MyLoginRequiredMixin, JsonSummaryMixin, UserMixin):
+
+    throttle_scope = 'cart'
 
     def get(self, request, *args, **kwargs):
         book_slug = kwargs.get('book_slug', '')
@@ -117,7 +153,9 @@ class DeleteFromWishList(MyLoginRequiredMixin, UserMixin):
         return redirect('wishlist_page')
 
 
-class AddToCart(MyLoginRequiredMixin, UserMixin):
+class AddToCart(ThrottleMixin, JsonSummaryMixin, UserMixin):
+
+    throttle_scope = 'cart'
 
     def get(self, request, *args, **kwargs):
         book_slug = kwargs.get('book_slug')
@@ -125,7 +163,9 @@ class AddToCart(MyLoginRequiredMixin, UserMixin):
         return redirect('book_detail', book_slug=book_slug)
 
 
-class RemoveFromCart(MyLoginRequiredMixin, UserMixin):
+class RemoveFromCart(ThrottleMixin, JsonSummaryMixin, UserMixin):
+
+    throttle_scope = 'cart'
 
     def get(self, request, *args, **kwargs):
         cart_item_id = kwargs.get('id')
@@ -143,15 +183,22 @@ class WishListView(MyLoginRequiredMixin, UserMixin, ListView):
         return self.wishlist.books.all().order_by('-id')
 
 
-class CartView(MyLoginRequiredMixin, UserMixin):
+class CartView(UserMixin):
 
     def get(self, request, *args, **kwargs):
         return render(request, 'bookapp/account_page/cart_page.html', self.get_context_data())
 
     def post(self, request, *args, **kwargs):
+        if not self.user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
         checkout_form = CheckoutForm(request.POST)
         if checkout_form.is_valid():
-            services.save_checkout(self, checkout_form)
+            try:
+                services.save_checkout(self, checkout_form)
+            except services.OutOfStockError as e:
+                messages.add_message(request, messages.ERROR, str(e))
+                return redirect('cart_page')
+            services.open_new_cart(request)
             messages.add_message(request, messages.SUCCESS,
                                  'You have succesfully placed an order')
             return redirect('main_page')
@@ -161,17 +208,22 @@ class CartView(MyLoginRequiredMixin, UserMixin):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['cart_final_qty'] = self.cart.get_cart_result('qty')
-        context['checkout_form'] = CheckoutForm(instance=self.account)
-        context['cart_products'] = self.cart.cart_items.all()
+        context['cart_final_qty'] = self.cart.total_qty
+        context['checkout_form'] = CheckoutForm(instance=getattr(self, 'account', None))
+        context['cart_products'] = services.get_cart_products(self)
         return context
 
 
-class RecalcCartView(MyLoginRequiredMixin, UserMixin):
+class RecalcCartView(UserMixin):
 
     def post(self, request, *args, **kwargs):
-        for id in request.POST:
-            services.update_cart_item_quantity(id, self.cart, request.POST)
+        quantities, errors = services.parse_cart_quantities(request.POST)
+        if not errors:
+            services.update_cart_items_quantities(self.cart, quantities)
+        if request.is_ajax():
+            return services.cart_totals_json_responce(self.cart, errors)
+        for error in errors.values():
+            messages.add_message(request, messages.ERROR, error)
         return redirect('cart_page')
 
 class AccountView(MyLoginRequiredMixin, UserMixin):
@@ -196,6 +248,7 @@ class AccountView(MyLoginRequiredMixin, UserMixin):
         context = super().get_context_data(**kwargs)
         context['form'] = UserAccountForm(instance=self.account)
         context['account'] = self.account
+        context['account_stats'] = services.get_account_stats(self.account)
         return context
 
 
@@ -203,10 +256,10 @@ class CheckoutsHistoryView(MyLoginRequiredMixin, UserMixin, ListView):
 
     template_name = 'bookapp/account_page/checkouts.html'
     context_object_name = 'checkouts'
+    paginate_by = 10
 
     def get_queryset(self, *args, **kwargs):
-        account = self.user.account
-        return account.checkouts.all().order_by('-id')
+        return self.account.checkouts.order_by('-id').prefetch_related('items')
 
 
 class BookComments(UserMixin, ListView):
@@ -238,11 +291,16 @@ class SearhView(UserMixin):
             input_data)
         context = self.get_context_data()
         context['categorys'] = category_queryset
-        context['books'] = book_queryset
+        context['books'] = services.annotate_books_memberships(self, book_queryset)
         return render(request, 'bookapp/search_result_page.html', context=context)
 
 
-class LoginView(View):
+class LoginView(ThrottleMixin, View):
+
+    throttle_scope = 'login'
+    throttle_methods = ('post', )
+    throttle_username_field = 'username'
+
     def get(self, request, *args, **kwargs):
         context = {
             'login_form': LoginForm()
@@ -252,15 +310,11 @@ class LoginView(View):
     def post(self, request, *args, **kwargs):
         login_form = LoginForm(request.POST)
         if login_form.is_valid():
-            username = login_form.cleaned_data['username']
-            password = login_form.cleaned_data['password']
             message_text = f'Welcome back <span class="username">@username</span>'
-            is_loged = services.authenticate_and_login_user(
-                request, username, password, message_text)
-            if is_loged:
-                return redirect('main_page')
-            else:
-                return redirect('login')
+            services.login_user(request, login_form.get_user(), message_text)
+            response = redirect('main_page')
+            services.merge_anonymous_cart(request, response)
+            return response
         context = {
             'login_form': login_form
         }
@@ -278,13 +332,17 @@ class RegistrationView(View):
     def post(self, request, *args, **kwargs):
         register_form = RegistrForm(request.POST)
         if register_form.is_valid():
-            user_model = services.register_user(register_form)
-            message_text = f'Hello! Ty for registration <span class="username">@{user_model.username}</span>'
-            services.authenticate_and_login_user(
-                request, user_model.username, register_form.cleaned_data['password'], message_text)
-            UserAccount.objects.create(
-                user=user_model, email=user_model.email)
-            return redirect('main_page')
+            username = register_form.cleaned_data['username']
+            message_text = f'Hello! Ty for registration <span class="username">@{username}</span>'
+            try:
+                services.register_and_login_user(request, register_form, message_text)
+            except IntegrityError:
+                # параллельная регистрация с тем же username
+                register_form.add_error('username', f'Username "{username}" is already taken')
+            else:
+                response = redirect('main_page')
+                services.merge_anonymous_cart(request, response)
+                return response
         context = {
             'register_form': register_form
         }
@@ -294,3 +352,9 @@ class RegistrationView(View):
 def logout_view(request):
     logout(request)
     return redirect('main_page')
+
+
+@staff_member_required
+def throttling_stats_view(request):
+    """ Счетчики из кеша этого процесса: с кешем в памяти процесса команда их не видит """
+    return JsonResponse(get_throttled_counts())
@@ -75,6 +75,80 @@ DATABASES = {
 }
 
 
+# Cache
+# Кеш должен быть общим для всех процессов (Memcached, Redis), в нем хранятся
+# версии скидок и бакеты throttling. По умолчанию - кеш в памяти процесса
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+
+# Sessions
+# Чтение из кеша, запись в базу только при изменении данных или когда срок хранения
+# в базе отстал больше чем на SESSION_EXPIRY_REFRESH_THRESHOLD секунд
+
+SESSION_ENGINE = 'bookapp.session_backend'
+SESSION_EXPIRY_REFRESH_THRESHOLD = 60 * 60 * 24
+
+
+# Thumbnails
+# Размеры рендишенов изображений (ширина, высота), для каждого создается еще retina-версия
+
+THUMBNAIL_SIZES = {
+    'card': (100, 150),
+    'detail': (300, 450),
+}
+THUMBNAIL_RETINA_SCALE = 2
+THUMBNAIL_QUALITY = 80
+
+
+# Uploads
+# Файлы пишутся на диск кусками, данные сверх FILE_UPLOAD_MAX_SIZE не сохраняются,
+# поэтому изображения в моделях - bookapp.fields.LimitedImageField, его форма отклоняет такие файлы
+
+FILE_UPLOAD_HANDLERS = ['bookapp.upload_handlers.LimitedTemporaryFileUploadHandler']
+FILE_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+
+# Аватар хранится в одном размере, изображения больше AVATAR_MAX_PIXELS не декодируются
+AVATAR_SIZE = (256, 256)
+AVATAR_MAX_PIXELS = 40 * 1000 * 1000
+
+
+# Recently viewed
+# Буфер последних просмотренных книг пользователя пишется в базу не чаще раза в интервал (секунды),
+# остальное раз в интервал дописывает процесс сайта при просмотре любой книги,
+# а с общим кешем еще и команда flush_recently_viewed
+
+RECENTLY_VIEWED_FLUSH_INTERVAL = 60 * 5
+
+
+# Throttling
+# scope: (capacity, period) - не больше capacity запросов за любые period секунд (скользящее окно)
+
+THROTTLE_RATES = {
+    'login': (20, 60),
+    'login_username': (5, 60),
+    'cart': (60, 60),
+}
+
+
+# Password hashing
+# Хеши со старым числом итераций обновляются при следующем входе пользователя
+
+PASSWORD_HASHER_ITERATIONS = int(os.environ.get('PASSWORD_HASHER_ITERATIONS', 260000))
+
+PASSWORD_HASHERS = [
+    'bookapp.hashers.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -119,6 +193,8 @@ STATICFILES_DIRS = (
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Загрузки именуются по sha256 содержимого, такие URL отдаются с Cache-Control: immutable
+DEFAULT_FILE_STORAGE = 'bookapp.storage.ContentAddressedStorage'
 
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
@@ -0,0 +1,112 @@
+from django.http import Http404
+
+from decimal import Decimal
+import json
+
+from bookapp.models import Book, CartItem
+
+
+ANONYMOUS_CART_COOKIE = 'cart'
+ANONYMOUS_CART_SALT = 'bookapp.anonymous_cart'
+ANONYMOUS_CART_MAX_AGE = 60 * 60 * 24 * 30
+ANONYMOUS_CART_MAX_ITEMS = 50
+
+
+class AnonymousCart:
+    """
+    Корзина анонимного посетителя в подписанной cookie, без строк в базе.
+    lines: {book_id: [qty, price]}, цена нужна для итогов в шапке без запросов
+    """
+
+    discount = Decimal('0')
+
+    def __init__(self, lines=None):
+        self.lines = lines or {}
+        self.modified = False
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(
+            ANONYMOUS_CART_COOKIE, default=None, salt=ANONYMOUS_CART_SALT)
+        try:
+            lines = json.loads(value) if value else {}
+        except ValueError:
+            lines = {}
+        return cls(lines)
+
+    def save(self, response):
+        if not self.modified:
+            return
+        if self.lines:
+            response.set_signed_cookie(
+                ANONYMOUS_CART_COOKIE, json.dumps(self.lines), salt=ANONYMOUS_CART_SALT,
+                max_age=ANONYMOUS_CART_MAX_AGE, httponly=True, samesite='Lax')
+        else:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE, samesite='Lax')
+
+    @property
+    def items_count(self):
+        return len(self.lines)
+
+    @property
+    def total_qty(self):
+        return sum(qty for qty, price in self.lines.values())
+
+    @property
+    def total_price(self):
+        return sum((Decimal(price) * qty for qty, price in self.lines.values()), Decimal('0'))
+
+    def get_cart_result(self, param):
+        summary_fields = {
+            'final_price': self.total_price - self.discount,
+            'qty': self.total_qty,
+        }
+        return summary_fields[param]
+
+    def get_quantities(self):
+        return {int(book_id): qty for book_id, (qty, price) in self.lines.items()}
+
+    def can_add(self, book):
+        return str(book.id) in self.lines or len(self.lines) < ANONYMOUS_CART_MAX_ITEMS
+
+    def add(self, book, qty=1):
+        """ Возвращает True, если книги еще не было в корзине """
+        line = self.lines.get(str(book.id))
+        self.lines[str(book.id)] = [(line[0] if line else 0) + qty, str(book.price)]
+        self.modified = True
+        return line is None
+
+    def remove(self, book_id):
+        if self.lines.pop(str(book_id), None) is not None:
+            self.modified = True
+
+    def update_quantities(self, quantities):
+        """ quantities: {book_id: qty}, qty = 0 удаляет книгу из корзины """
+        if not set(map(str, quantities)) <= set(self.lines):
+            raise Http404('No CartItem matches the given query.')
+        for book_id, qty in quantities.items():
+            if qty == 0:
+                del self.lines[str(book_id)]
+            else:
+                self.lines[str(book_id)][0] = qty
+        self.modified = True
+
+    def clear(self):
+        self.lines = {}
+        self.modified = True
+
+    def get_cart_items(self):
+        """ Несохраненные CartItem для шаблона корзины, id позиции = id книги """
+        books = Book.objects.in_bulk(self.get_quantities())
+        cart_items = []
+        for book_id, (qty, price) in list(self.lines.items()):
+            book = books.get(int(book_id))
+            if book is None:
+                self.remove(book_id)
+                continue
+            if str(book.price) != price:
+                self.lines[book_id][1] = str(book.price)
+                self.modified = True
+            cart_items.append(CartItem(
+                id=book.id, book=book, qty=qty, final_price=book.price * qty))
+        return cart_items
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+import io
+import os
+
+from PIL import Image, ImageOps
+
+
+def get_center_crop_box(size, ratio):
+    """ Наибольшая область по центру изображения с соотношением сторон ratio """
+    width, height = size
+    if width / height > ratio:
+        crop_width = height * ratio
+        return (width - crop_width) / 2, 0, (width + crop_width) / 2, height
+    crop_height = width / ratio
+    return 0, (height - crop_height) / 2, width, (height + crop_height) / 2
+
+
+def fit_avatar_size(box):
+    """ Маленькие изображения не увеличиваются """
+    width, height = settings.AVATAR_SIZE
+    crop_width = box[2] - box[0]
+    if crop_width >= width:
+        return width, height
+    return max(1, round(crop_width)), max(1, round(crop_width * height / width))
+
+
+def normalize_avatar(uploaded_file):
+    """
+    Аватар в размере AVATAR_SIZE без метаданных (EXIF, ICC) в JPEG.
+    JPEG декодируется сразу в уменьшенном виде (draft), остальные форматы -
+    целиком, их размер в пикселях уже ограничен формой
+    """
+    width, height = settings.AVATAR_SIZE
+    uploaded_file.seek(0)
+    with Image.open(uploaded_file) as image:
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        box = get_center_crop_box(image.size, width / height)
+        avatar = image.resize(fit_avatar_size(box), Image.LANCZOS, box=box, reducing_gap=3.0)
+    buffer = io.BytesIO()
+    avatar.save(buffer, 'JPEG', quality=settings.THUMBNAIL_QUALITY, optimize=True)
+    name = os.path.splitext(os.path.basename(uploaded_file.name))[0]
+    return ContentFile(buffer.getvalue(), name=f'{name}.jpg')
+
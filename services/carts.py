@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from bookapp.models import Cart, CartItem
+from services.memberships import invalidate_memberships
+from services.promotions import get_cart_discount, get_promotions_version
+
+
+def recalc_cart_summary(cart):
+    """
+    Пересчитывает денормализованные итоги и скидку корзины и сохраняет их.
+    Вызывается при изменении позиций корзины и при оформлении заказа
+    """
+    promotions_version = get_promotions_version()
+    summary = cart.cart_items.aggregate(
+        items_count=Count('id'), total_qty=Sum('qty'), total_price=Sum('final_price'))
+    cart.items_count = summary['items_count']
+    cart.total_qty = summary['total_qty'] or 0
+    cart.total_price = summary['total_price'] or 0
+    cart.discount = get_cart_discount(cart, promotions_version) if cart.items_count else 0
+    cart.promotions_version = promotions_version
+    cart.save(update_fields=['items_count', 'total_qty', 'total_price',
+                             'discount', 'promotions_version'])
+    invalidate_memberships(cart.user_id)
+
+
+def recalc_cart_totals(cart_id):
+    """
+    Пересчитывает итоги корзины одним UPDATE с подзапросами, не загружая ее.
+    Для удалений позиций в обход CartItem: каскад от книги, QuerySet.delete в админке.
+    promotions_version сбрасывается, чтобы discount пересчитался при следующем чтении корзины
+    """
+    cart_items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.filter(id=cart_id).update(
+        items_count=Coalesce(Subquery(cart_items.annotate(count=Count('id')).values('count')), 0),
+        total_qty=Coalesce(Subquery(cart_items.annotate(qty=Sum('qty')).values('qty')), 0),
+        total_price=Coalesce(Subquery(
+            cart_items.annotate(price=Sum('final_price')).values('price')), Decimal('0')),
+        promotions_version='')
+    user_id = Cart.objects.filter(id=cart_id).values_list('user_id', flat=True).first()
+    if user_id:
+        invalidate_memberships(user_id)
+
+
+def apply_current_discount(cart):
+    """
+    Если правила скидок сменились после последнего пересчета, считает discount заново
+    и сохраняет его один раз на версию условным UPDATE: запись не перетрет пересчет,
+    который параллельно сделал recalc_cart_summary. Возвращает True, если discount был пересчитан
+    """
+    promotions_version = get_promotions_version()
+    if cart.promotions_version == promotions_version:
+        return False
+    old_version = cart.promotions_version
+    cart.discount = get_cart_discount(cart, promotions_version) if cart.items_count else 0
+    cart.promotions_version = promotions_version
+    Cart.objects.filter(id=cart.id, promotions_version=old_version).update(
+        discount=cart.discount, promotions_version=promotions_version)
+    return True
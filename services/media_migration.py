@@ -0,0 +1,93 @@
+from django.core.files.storage import default_storage
+
+from collections import Counter
+
+from PIL import Image
+
+from bookapp.models import (
+    DEFAULT_AVATAR, DEFAULT_BOOK_IMAGE, Book, ThumbnailSource, UserAccount, get_default_avatar, get_default_book_image)
+from bookapp.storage import is_content_name
+from services.thumbnails import (
+    PLACEHOLDER_RENDITION, get_renditions, get_thumbnail_name, render_thumbnails, save_thumbnails)
+
+
+def move_to_content_name(storage, name):
+    """ Возвращает (имя по содержимому, был ли такой файл уже сохранен) """
+    with storage.open(name) as content:
+        content_name = storage.get_content_name(name, content)
+        existed = storage.exists(content_name)
+        storage.save(name, content)
+    return content_name, existed
+
+
+def move_thumbnails(storage, name, content_name):
+    """
+    Рендишены переезжают вместе с обложкой: копируются под новое имя,
+    а если их не было - создаются заново. Нечитаемый оригинал шаблон покажет как есть
+    """
+    renditions = [*get_renditions(), PLACEHOLDER_RENDITION]
+    if all(storage.exists(get_thumbnail_name(content_name, rendition)) for rendition in renditions):
+        return
+    if all(storage.exists(get_thumbnail_name(name, rendition)) for rendition in renditions):
+        thumbnails = {}
+        for rendition in renditions:
+            with storage.open(get_thumbnail_name(name, rendition)) as thumbnail:
+                thumbnails[rendition] = thumbnail.read()
+    else:
+        try:
+            with storage.open(content_name) as source:
+                thumbnails = render_thumbnails(source)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return
+    save_thumbnails(storage, content_name, thumbnails)
+
+
+def move_thumbnail_source(name, content_name):
+    """ Запись манифеста regenerate_thumbnails переходит на новое имя, чтобы файл не разбирался заново """
+    if ThumbnailSource.objects.filter(name=content_name).exists():
+        ThumbnailSource.objects.filter(name=name).delete()
+    else:
+        ThumbnailSource.objects.filter(name=name).update(name=content_name)
+
+
+def delete_with_thumbnails(storage, name):
+    for thumbnail_name in [get_thumbnail_name(name, rendition)
+                           for rendition in [*get_renditions(), PLACEHOLDER_RENDITION]]:
+        if storage.exists(thumbnail_name):
+            storage.delete(thumbnail_name)
+    storage.delete(name)
+
+
+def content_address_media(delete_originals=False):
+    """
+    Переносит Book.image и UserAccount.image под имена по содержимому и обновляет ссылки
+    одним UPDATE на исходное имя. Одинаковые файлы сводятся к одному.
+    Вместе с обложками переносятся их рендишены и записи манифеста ThumbnailSource.
+    Изображения по умолчанию копируются, оригиналы остаются - по ним ищется копия.
+    Возвращает Counter: moved, deduplicated, missing
+    """
+    storage = default_storage
+    counts = Counter()
+    get_default_book_image()
+    get_default_avatar()
+    moved_names = []
+    for model in (Book, UserAccount):
+        # order_by() убирает id из Meta.ordering, иначе DISTINCT вернул бы имя на каждую книгу
+        names = model.objects.exclude(image='').order_by().values_list('image', flat=True).distinct()
+        for name in list(names):
+            if is_content_name(name):
+                continue
+            if not storage.exists(name):
+                counts['missing'] += 1
+                continue
+            content_name, existed = move_to_content_name(storage, name)
+            if model is Book:
+                move_thumbnails(storage, name, content_name)
+                move_thumbnail_source(name, content_name)
+            model.objects.filter(image=name).update(image=content_name)
+            counts['deduplicated' if existed else 'moved'] += 1
+            moved_names.append(name)
+    if delete_originals:
+        for name in set(moved_names) - {DEFAULT_BOOK_IMAGE, DEFAULT_AVATAR}:
+            delete_with_thumbnails(storage, name)
+    return counts
@@ -0,0 +1,52 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import CharField, IntegerField, Value
+
+from bookapp.models import CartItem, WishListItem
+
+
+MEMBERSHIPS_KEY = 'memberships'
+MEMBERSHIPS_TIMEOUT = 60 * 60
+
+
+def get_memberships_key(user_id):
+    return f'{MEMBERSHIPS_KEY}:{user_id}'
+
+
+def load_memberships(cart_id, wishlist_id):
+    """ Книги корзины с количеством и книги вишлиста одним UNION запросом """
+    cart_rows = CartItem.objects.filter(cart_id=cart_id).annotate(
+        kind=Value('cart', output_field=CharField())).values_list('book_id', 'qty', 'kind')
+    wishlist_rows = WishListItem.objects.filter(wishlist_id=wishlist_id).annotate(
+        qty=Value(0, output_field=IntegerField()),
+        kind=Value('wishlist', output_field=CharField())).values_list('book_id', 'qty', 'kind')
+    memberships = {'cart_id': cart_id, 'cart': {}, 'wishlist': set()}
+    for book_id, qty, kind in cart_rows.union(wishlist_rows, all=True):
+        if kind == 'cart':
+            memberships['cart'][book_id] = qty
+        else:
+            memberships['wishlist'].add(book_id)
+    return memberships
+
+
+def get_memberships(user_id, cart_id, wishlist_id):
+    """
+    {'cart': {book_id: qty}, 'wishlist': {book_id}} пользователя из кеша.
+    После заказа у пользователя новая корзина, поэтому запись со старым cart_id перечитывается
+    """
+    key = get_memberships_key(user_id)
+    memberships = cache.get(key)
+    if memberships is None or memberships['cart_id'] != cart_id:
+        memberships = load_memberships(cart_id, wishlist_id)
+        cache.set(key, memberships, MEMBERSHIPS_TIMEOUT)
+    return memberships
+
+
+def invalidate_memberships(user_id):
+    """
+    Удаляет запись сразу (текущий запрос видит свои изменения) и еще раз после коммита:
+    параллельный запрос мог прочитать старое состояние до коммита и снова положить его в кеш
+    """
+    key = get_memberships_key(user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
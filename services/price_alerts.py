@@ -0,0 +1,75 @@
+from django.core.mail import send_mass_mail
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from bookapp.models import PriceDropNotification, WishListItem
+
+
+PRICE_DROP_SUBJECT = 'The price of "{title}" has dropped'
+PRICE_DROP_MESSAGE = 'The book "{title}" from your wishlist now costs {new_price}$ instead of {old_price}$.'
+
+
+def collect_price_drops(chunk_size=10000):
+    """
+    Находит книги вишлистов, которые стали дешевле цены на момент добавления,
+    и пишет уведомления в outbox. Вишлисты обходятся диапазонами id по chunk_size,
+    каждый диапазон - один запрос с join на книгу и вишлист и один bulk INSERT.
+    Уже записанные уведомления о той же цене пропускаются уникальным индексом.
+    Возвращает количество найденных снижений цены
+    """
+    max_id = WishListItem.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    found_count = 0
+    for start in range(1, max_id + 1, chunk_size):
+        rows = WishListItem.objects.filter(
+            id__gte=start, id__lt=start + chunk_size,
+            price_added__isnull=False, book__price__lt=F('price_added'),
+            # вишлист без пользователя (WishList.user nullable) уведомлять некому
+            wishlist__user__isnull=False,
+        ).values_list('wishlist__user_id', 'book_id', 'price_added', 'book__price')
+        notifications = [
+            PriceDropNotification(user_id=user_id, book_id=book_id, old_price=old_price, new_price=new_price)
+            for user_id, book_id, old_price, new_price in rows
+        ]
+        PriceDropNotification.objects.bulk_create(notifications, ignore_conflicts=True)
+        found_count += len(notifications)
+    return found_count
+
+
+def get_notification_email(user):
+    account = getattr(user, 'account', None)
+    return (account.email if account else '') or user.email
+
+
+def send_price_drop_notifications(batch_size=500):
+    """
+    Отправляет неотправленные уведомления пачками по batch_size и отмечает их отправленными
+    в той же транзакции. Строки пачки блокируются с skip_locked, поэтому несколько отправителей
+    не отправят одно уведомление дважды. Возвращает количество отправленных писем
+    """
+    sent_count = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                PriceDropNotification.objects.filter(date_sent__isnull=True)
+                .select_related('user__account', 'book')
+                .select_for_update(skip_locked=True, of=('self', ))
+                .order_by('id')[:batch_size])
+            if not batch:
+                break
+            datatuple = []
+            for notification in batch:
+                email = get_notification_email(notification.user)
+                if not email:
+                    continue
+                context = {
+                    'title': notification.book.title,
+                    'old_price': notification.old_price,
+                    'new_price': notification.new_price,
+                }
+                datatuple.append((
+                    PRICE_DROP_SUBJECT.format(**context), PRICE_DROP_MESSAGE.format(**context), None, [email]))
+            sent_count += send_mass_mail(datatuple)
+            PriceDropNotification.objects.filter(
+                id__in=[notification.id for notification in batch]).update(date_sent=timezone.now())
+    return sent_count
@@ -0,0 +1,123 @@
+from django.core.cache import cache
+from django.db import transaction
+
+from decimal import Decimal
+import uuid
+
+from bookapp.models import Book, Promotion
+
+
+PROMOTIONS_VERSION_KEY = 'promotions_version'
+PROMOTIONS_RULES_KEY = 'promotions_rules'
+
+CENT = Decimal('0.01')
+
+
+def get_promotions_version():
+    version = cache.get(PROMOTIONS_VERSION_KEY)
+    if version is None:
+        version = set_new_promotions_version()
+    return version
+
+
+def set_new_promotions_version():
+    version = uuid.uuid4().hex
+    cache.set(PROMOTIONS_VERSION_KEY, version, None)
+    return version
+
+
+def bump_promotions_version():
+    """
+    Вызывается при любом изменении скидок, корзины пересчитают discount при следующем чтении.
+    Версия меняется сразу (изменения видны в текущей транзакции) и еще раз после коммита,
+    чтобы правила, скомпилированные другими процессами до коммита, не остались в кеше.
+    """
+    transaction.on_commit(set_new_promotions_version)
+    return set_new_promotions_version()
+
+
+def compile_promotions():
+    """
+    Собирает активные скидки в таблицы поиска:
+    {'book': {book_id: [(discount_type, value)]}, 'bookcategory': {...},
+     'specialcategory': {...}, 'cart': [(min_cart_total, discount_type, value)]}
+    """
+    rules = {'book': {}, 'bookcategory': {}, 'specialcategory': {}, 'cart': []}
+    promotions = Promotion.objects.filter(is_active=True).values_list(
+        'discount_type', 'value', 'book_id', 'bookcategory_id', 'specialcategory_id', 'min_cart_total')
+    for discount_type, value, book_id, bookcategory_id, specialcategory_id, min_cart_total in promotions:
+        rule = (discount_type, value)
+        if book_id:
+            rules['book'].setdefault(book_id, []).append(rule)
+        elif bookcategory_id:
+            rules['bookcategory'].setdefault(bookcategory_id, []).append(rule)
+        elif specialcategory_id:
+            rules['specialcategory'].setdefault(specialcategory_id, []).append(rule)
+        else:
+            rules['cart'].append((min_cart_total, *rule))
+    return rules
+
+
+def get_compiled_promotions(version):
+    key = f'{PROMOTIONS_RULES_KEY}:{version}'
+    rules = cache.get(key)
+    if rules is None:
+        rules = compile_promotions()
+        cache.set(key, rules, None)
+    return rules
+
+
+def get_discount(discount_type, value, price, qty=1):
+    if discount_type == Promotion.PERCENT:
+        return min(price * value / 100, price).quantize(CENT)
+    return min(value * qty, price)
+
+
+def get_books_categories(through_model, category_field, book_ids, category_ids):
+    """ {book_id: [category_id]} только для категорий, на которые есть скидки """
+    if not category_ids:
+        return {}
+    books_categories = {}
+    rows = through_model.objects.filter(
+        book_id__in=book_ids, **{f'{category_field}__in': category_ids}
+    ).values_list('book_id', category_field)
+    for book_id, category_id in rows:
+        books_categories.setdefault(book_id, []).append(category_id)
+    return books_categories
+
+
+def get_cart_discount(cart, version=None):
+    """
+    Считает скидку корзины за один проход по позициям.
+    На позицию действует лучшая из подходящих скидок (книга или ее категории),
+    затем на оставшуюся сумму - лучшая из скидок на корзину.
+    """
+    rules = get_compiled_promotions(version or get_promotions_version())
+    if not any(rules.values()):
+        return Decimal('0')
+    lines = list(cart.cart_items.values_list('book_id', 'qty', 'final_price'))
+    book_ids = [book_id for book_id, qty, final_price in lines]
+    bookcategories = get_books_categories(
+        Book.bookcategories.through, 'bookcategory_id', book_ids, list(rules['bookcategory']))
+    specialcategories = get_books_categories(
+        Book.specialcategories.through, 'specialcategory_id', book_ids, list(rules['specialcategory']))
+
+    subtotal = Decimal('0')
+    discount = Decimal('0')
+    for book_id, qty, final_price in lines:
+        line_rules = list(rules['book'].get(book_id, []))
+        for category_id in bookcategories.get(book_id, []):
+            line_rules.extend(rules['bookcategory'][category_id])
+        for category_id in specialcategories.get(book_id, []):
+            line_rules.extend(rules['specialcategory'][category_id])
+        discount += max(
+            (get_discount(discount_type, value, final_price, qty) for discount_type, value in line_rules),
+            default=Decimal('0'))
+        subtotal += final_price
+
+    rest = subtotal - discount
+    discount += max(
+        (get_discount(discount_type, value, rest)
+         for min_cart_total, discount_type, value in rules['cart'] if rest >= min_cart_total),
+        default=Decimal('0'))
+    return discount
@@ -0,0 +1,161 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import BadSignature
+
+import json
+import time
+
+from bookapp.models import Book, RecentlyViewedBooks
+
+
+RECENTLY_VIEWED_SIZE = 12
+RECENTLY_VIEWED_COOKIE = 'recently_viewed'
+RECENTLY_VIEWED_SALT = 'bookapp.recently_viewed'
+RECENTLY_VIEWED_MAX_AGE = 60 * 60 * 24 * 30
+RECENTLY_VIEWED_KEY = 'recently_viewed'
+# Очередь буферов, которые еще не записаны в базу: номер из счетчика -> user_id
+RECENTLY_VIEWED_DIRTY_KEY = 'recently_viewed_dirty'
+RECENTLY_VIEWED_DIRTY_SEQ_KEY = 'recently_viewed_dirty_seq'
+RECENTLY_VIEWED_FLUSHED_SEQ_KEY = 'recently_viewed_flushed_seq'
+# Пользователь уже стоит в очереди, повторные просмотры его не добавляют
+RECENTLY_VIEWED_PENDING_KEY = 'recently_viewed_pending'
+# Очередь уже разбиралась в текущем интервале
+RECENTLY_VIEWED_FLUSH_LOCK_KEY = 'recently_viewed_flush_lock'
+
+
+def get_recently_viewed_key(user_id):
+    return f'{RECENTLY_VIEWED_KEY}:{user_id}'
+
+
+def get_pending_key(user_id):
+    return f'{RECENTLY_VIEWED_PENDING_KEY}:{user_id}'
+
+
+def get_dirty_key(seq):
+    return f'{RECENTLY_VIEWED_DIRTY_KEY}:{seq}'
+
+
+def mark_dirty(user_id):
+    """ Ставит буфер пользователя в очередь flush_recently_viewed, если его там еще нет """
+    if not cache.add(get_pending_key(user_id), 1, RECENTLY_VIEWED_MAX_AGE):
+        return
+    cache.add(RECENTLY_VIEWED_DIRTY_SEQ_KEY, 0, None)
+    try:
+        seq = cache.incr(RECENTLY_VIEWED_DIRTY_SEQ_KEY)
+    except ValueError:
+        # счетчик вытеснили из кеша между add и incr
+        cache.set(RECENTLY_VIEWED_DIRTY_SEQ_KEY, 1, None)
+        seq = 1
+    cache.set(get_dirty_key(seq), user_id, RECENTLY_VIEWED_MAX_AGE)
+
+
+def flush_recently_viewed():
+    """
+    Пишет в базу буферы пользователей из очереди, запускается по расписанию
+    раз в RECENTLY_VIEWED_FLUSH_INTERVAL. Возвращает количество записанных буферов
+    """
+    flushed_seq = cache.get(RECENTLY_VIEWED_FLUSHED_SEQ_KEY, 0)
+    seq = cache.get(RECENTLY_VIEWED_DIRTY_SEQ_KEY, 0)
+    if seq < flushed_seq:
+        # счетчик очереди начался заново
+        flushed_seq = 0
+    dirty_keys = [get_dirty_key(i) for i in range(flushed_seq + 1, seq + 1)]
+    flushed_count = 0
+    for user_id in set(cache.get_many(dirty_keys).values()):
+        # метка снимается до чтения буфера: просмотр после этого снова поставит его в очередь
+        if not cache.get(get_pending_key(user_id)):
+            continue
+        cache.delete(get_pending_key(user_id))
+        cached = cache.get(get_recently_viewed_key(user_id))
+        if cached is None:
+            continue
+        RecentlyViewedBooks.objects.update_or_create(user_id=user_id, defaults={'book_ids': cached['book_ids']})
+        flushed_count += 1
+    cache.delete_many(dirty_keys)
+    cache.set(RECENTLY_VIEWED_FLUSHED_SEQ_KEY, seq, None)
+    return flushed_count
+
+
+def flush_recently_viewed_if_due():
+    """
+    Разбирает очередь из процесса сайта не чаще раза в RECENTLY_VIEWED_FLUSH_INTERVAL.
+    С кешем в памяти процесса очередь видна только ему самому, команда ее не найдет
+    """
+    if cache.add(RECENTLY_VIEWED_FLUSH_LOCK_KEY, 1, settings.RECENTLY_VIEWED_FLUSH_INTERVAL):
+        return flush_recently_viewed()
+    return 0
+
+
+class RecentlyViewed:
+    """
+    Кольцевой буфер id последних просмотренных книг, новые в начале, не больше RECENTLY_VIEWED_SIZE.
+    Анонимный посетитель хранит буфер в подписанной cookie, пользователь - в кеше.
+    В базу (RecentlyViewedBooks) буфер пользователя пишется не чаще раза
+    в RECENTLY_VIEWED_FLUSH_INTERVAL секунд, просмотры между записями объединяются.
+    Буфер, не записанный при просмотре, дописывает следующий просмотр любого посетителя
+    через flush_recently_viewed_if_due или команда flush_recently_viewed
+    """
+
+    def __init__(self, user, book_ids=None, flushed_at=None):
+        self.user = user
+        self.book_ids = book_ids or []
+        self.flushed_at = flushed_at
+        self.modified = False
+
+    @classmethod
+    def from_request(cls, request):
+        user = request.user
+        if not user.is_authenticated:
+            try:
+                value = request.get_signed_cookie(
+                    RECENTLY_VIEWED_COOKIE, default=None, salt=RECENTLY_VIEWED_SALT)
+                book_ids = [int(book_id) for book_id in json.loads(value)] if value else []
+            except (BadSignature, ValueError, TypeError):
+                book_ids = []
+            return cls(user, book_ids[:RECENTLY_VIEWED_SIZE])
+
+        cached = cache.get(get_recently_viewed_key(user.id))
+        if cached is None:
+            # буфер в кеше потерян или еще не создан - берем сохраненный в базе
+            stored = RecentlyViewedBooks.objects.filter(user=user).values_list('book_ids', 'date_updated').first()
+            if stored is None:
+                return cls(user)
+            book_ids, date_updated = stored
+            return cls(user, book_ids, flushed_at=date_updated.timestamp())
+        return cls(user, cached['book_ids'], flushed_at=cached['flushed_at'])
+
+    def push(self, book_id):
+        if self.book_ids[:1] == [book_id]:
+            return
+        self.book_ids = [book_id, *(i for i in self.book_ids if i != book_id)][:RECENTLY_VIEWED_SIZE]
+        self.modified = True
+
+    def is_flush_due(self):
+        return self.flushed_at is None or time.time() - self.flushed_at >= settings.RECENTLY_VIEWED_FLUSH_INTERVAL
+
+    def flush(self):
+        RecentlyViewedBooks.objects.update_or_create(user=self.user, defaults={'book_ids': self.book_ids})
+        self.flushed_at = time.time()
+        cache.delete(get_pending_key(self.user.id))
+
+    def save(self, response):
+        if not self.modified:
+            return
+        if not self.user.is_authenticated:
+            response.set_signed_cookie(
+                RECENTLY_VIEWED_COOKIE, json.dumps(self.book_ids), salt=RECENTLY_VIEWED_SALT,
+                max_age=RECENTLY_VIEWED_MAX_AGE, httponly=True, samesite='Lax')
+            return
+        flush_due = self.is_flush_due()
+        if flush_due:
+            self.flush()
+        cache.set(get_recently_viewed_key(self.user.id),
+                  {'book_ids': self.book_ids, 'flushed_at': self.flushed_at}, RECENTLY_VIEWED_MAX_AGE)
+        if not flush_due:
+            mark_dirty(self.user.id)
+
+    def get_books(self, exclude_id=None):
+        """ Книги одним запросом id__in в порядке буфера, удаленные книги пропускаются """
+        book_ids = [book_id for book_id in self.book_ids if book_id != exclude_id]
+        books = Book.objects.in_bulk(book_ids)
+        return [books[book_id] for book_id in book_ids if book_id in books]
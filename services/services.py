@@ -1,4 +1,18 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F, Count, Sum, Max, Min, OuterRef, Subquery
+from django.db.models.functions import TruncMonth, Coalesce
+from django.http import Http404
+from django.contrib.auth.hashers import make_password
+
+from decimal import Decimal
+
 from bookapp.views import *
+from services.anonymous_cart import AnonymousCart
+from services.carts import apply_current_discount, recalc_cart_summary
+from services.memberships import get_memberships, invalidate_memberships
+from services.shopping_context import (
+    create_new_shopping_context, load_shopping_context, open_new_cart, save_shopping_context)
+from bookapp.models import BOOK_SORTINGS, get_default_avatar, User, WishListItem, BookPriceHistory, Checkout, CheckoutItem, UserAccountStats, UserAccountMonthlyStats
 
 
 # MainPage
@@ -14,6 +28,44 @@ def get_queryset_for_main_page(instance, slug=''):
         instance.is_it_special = False
 
 
+# MainPage, BookCategoryDetail
+def get_sorted_books_queryset(instance, queryset, default_ordering=('id', )):
+    sort = instance.request.GET.get('sort', '')
+    if sort not in BOOK_SORTINGS:
+        sort = ''
+    instance.sort = sort
+    ordering = BOOK_SORTINGS[sort] if sort else default_ordering
+    queryset = queryset.order_by(*ordering)
+    cursor = instance.request.GET.get('after', '')
+    instance.cursor = int(cursor) if cursor.isdigit() else None
+    if instance.cursor is not None:
+        queryset = filter_books_after_cursor(queryset, ordering, instance.cursor)
+    return queryset
+
+
+def get_next_cursor(instance, page_obj):
+    """ id последней книги на странице для ссылки ?after= в отсортированном списке """
+    if not instance.sort or not page_obj.has_next() or not page_obj.object_list:
+        return None
+    return page_obj.object_list[-1].id
+
+
+def filter_books_after_cursor(queryset, ordering, cursor):
+    """ Keyset пагинация: книги, которые идут после книги с id=cursor в данном ordering """
+    fields = [field.lstrip('-') for field in ordering]
+    last_book = Book.objects.filter(id=cursor).values(*fields).first()
+    if last_book is None:
+        return queryset
+    condition = Q()
+    equal_fields = {}
+    for field in ordering:
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal_fields, **{f'{name}__{lookup}': last_book[name]})
+        equal_fields[name] = last_book[name]
+    return queryset.filter(condition)
+
+
 # BookDetail
 def save_comment_and_return_comment_model(instance, form):
     comment_model = form.save(commit=False)
@@ -37,8 +89,25 @@ def json_responce(instance, comment_model):
     }}, status=200)
 
 
-def is_book_on_wishlist(instance):
-    return instance.wishlist.books.filter(slug=instance.object.slug).exists()
+def get_book_memberships(instance):
+    """ Книги корзины и вишлиста текущего пользователя, один раз на запрос """
+    if not hasattr(instance, 'memberships'):
+        if isinstance(instance.cart, AnonymousCart):
+            instance.memberships = {'cart': instance.cart.get_quantities(), 'wishlist': set()}
+        else:
+            instance.memberships = get_memberships(
+                instance.user.id, instance.cart.id, instance.wishlist.id)
+    return instance.memberships
+
+
+def annotate_books_memberships(instance, books):
+    """ Проставляет книгам count_in_cart и is_on_wishlist для значков без запроса на каждую книгу """
+    memberships = get_book_memberships(instance)
+    books = list(books)
+    for book in books:
+        book.count_in_cart = memberships['cart'].get(book.id, 0)
+        book.is_on_wishlist = book.id in memberships['wishlist']
+    return books
 
 
 def get_book_comments(instance):
@@ -57,64 +126,317 @@ def get_also_like_books_queryset(instance):
 
 # AddToWishList
 def add_book_to_wishlist(instance, request, slug):
-    if not instance.wishlist.books.filter(slug=slug).exists():
-        book_model = get_object_or_404(Book, slug=slug)
-        instance.wishlist.books.add(book_model)
-        messages.add_message(request, messages.SUCCESS, 'Added to wish list')
-    else:
+    """ Повторное добавление ловит unique (wishlist, book), без предварительной проверки """
+    book_model = get_object_or_404(Book, slug=slug)
+    try:
+        with transaction.atomic():
+            WishListItem.objects.create(
+                wishlist=instance.wishlist, book=book_model, price_added=book_model.price)
+    except IntegrityError:
         messages.add_message(request, messages.WARNING,
                              'You already added this book to wishlist')
+    else:
+        invalidate_memberships(instance.wishlist.user_id)
+        messages.add_message(request, messages.SUCCESS, 'Added to wish list')
 
 
 # DeleteFromWishList
 def delete_book_from_wishlist(instance, request, slug):
-    if instance.wishlist.books.filter(slug=slug).exists():
-        book_model = get_object_or_404(Book, slug=slug)
-        instance.wishlist.books.remove(book_model)
-    else:
+    with transaction.atomic():
+        deleted, deleted_by_model = WishListItem.objects.filter(
+            wishlist=instance.wishlist, book__slug=slug).delete()
+        if deleted:
+            invalidate_memberships(instance.wishlist.user_id)
+    if not deleted:
         messages.add_message(request, messages.WARNING,
                              'This book isn`t on your wishlist')
 
 
+# move_wishlist_items command
+def move_legacy_wishlist_books(batch_size=1000):
+    """
+    Переносит книги из устаревшего Book.wishlist в WishListItem
+    и пересчитывает items_count у всех вишлистов. Возвращает количество перенесенных книг
+    """
+    with transaction.atomic():
+        legacy_books = Book.objects.filter(wishlist__isnull=False)
+        WishListItem.objects.bulk_create([
+            WishListItem(wishlist_id=wishlist_id, book_id=book_id, price_added=price)
+            for book_id, wishlist_id, price in legacy_books.values_list('id', 'wishlist_id', 'price')
+        ], batch_size=batch_size, ignore_conflicts=True)
+        moved_count = legacy_books.update(wishlist=None)
+        recount_wishlist_items()
+    return moved_count
+
+
+def recount_wishlist_items():
+    items_count = WishListItem.objects.filter(wishlist=OuterRef('id')).values(
+        'wishlist').annotate(count=Count('id')).values('count')
+    WishList.objects.update(items_count=Coalesce(Subquery(items_count), 0))
+
+
 # AddToCart
 def add_book_to_cart(instance, request, slug):
     book = get_object_or_404(Book, slug=slug)
-    if not instance.cart.cart_items.filter(book=book).exists():
-        cart_item = CartItem.objects.create(
-            book=book, qty=1, cart=instance.cart
-        )
+    if isinstance(instance.cart, AnonymousCart):
+        if not instance.cart.can_add(book):
+            messages.add_message(request, messages.WARNING,
+                                 'Your cart is full, please sign in to add more books')
+            return
+        created = instance.cart.add(book)
+    else:
+        created = upsert_cart_item(instance.cart, book)
+    if created:
         messages.add_message(request, messages.SUCCESS,
                              'Book added to cart')
     else:
-        cart_item = instance.cart.cart_items.get(book=book)
-        cart_item.qty += 1
-        cart_item.save()
         messages.add_message(
             request, messages.INFO, 'The cart already contains this book, the qty has been increased by 1')
 
 
+def increment_cart_item_qty(cart, book, qty):
+    return CartItem.objects.filter(cart=cart, book=book).update(
+        qty=F('qty') + qty, final_price=(F('qty') + qty) * book.price)
+
+
+def upsert_cart_item(cart, book, qty=1):
+    """
+    Атомарно добавляет книгу в корзину: увеличивает qty в базе или создает позицию.
+    Вставку от параллельного запроса ловит unique (cart, book), после чего делаем UPDATE.
+    Возвращает True, если позиция была создана.
+    """
+    with transaction.atomic():
+        if increment_cart_item_qty(cart, book, qty):
+            recalc_cart_summary(cart)
+            return False
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(book=book, qty=qty, cart=cart)
+            return True
+        except IntegrityError:
+            increment_cart_item_qty(cart, book, qty)
+            recalc_cart_summary(cart)
+            return False
+
+
+def merge_duplicate_cart_items():
+    """
+    Сводит повторы (cart, book) в CartItem в одну позицию: qty и final_price складываются,
+    остальные строки удаляются. Итоги корзины от этого не меняются.
+    Запускать до миграции с unique_cart_item_book. Возвращает количество удаленных строк
+    """
+    duplicates = CartItem.objects.filter(cart__isnull=False).values('cart_id', 'book_id').annotate(
+        items_count=Count('id'), keep_id=Min('id'),
+        total_qty=Sum('qty'), total_final_price=Sum('final_price'),
+    ).filter(items_count__gt=1)
+    deleted_count = 0
+    with transaction.atomic():
+        for duplicate in duplicates:
+            CartItem.objects.filter(id=duplicate['keep_id']).update(
+                qty=duplicate['total_qty'], final_price=duplicate['total_final_price'])
+            deleted_count += CartItem.objects.filter(
+                cart_id=duplicate['cart_id'], book_id=duplicate['book_id'],
+            ).exclude(id=duplicate['keep_id']).delete()[0]
+    return deleted_count
+
+
 # RemoveFromCart
 def remove_book_from_cart(instance, cart_item_id):
-    if instance.cart.cart_items.filter(id=cart_item_id).exists():
-        cart_item = get_object_or_404(CartItem, id=cart_item_id)
-        cart_item.delete()
+    if isinstance(instance.cart, AnonymousCart):
+        instance.cart.remove(cart_item_id)
+    else:
+        cart_item = instance.cart.cart_items.filter(id=cart_item_id).first()
+        if cart_item:
+            with transaction.atomic():
+                cart_item.delete()
+                # post_delete уже поправил итоги в базе, а instance.cart и discount - нет
+                recalc_cart_summary(instance.cart)
 
 
 # CartView
+class OutOfStockError(Exception):
+
+    def __init__(self, book_title):
+        self.book_title = book_title
+        super().__init__(f'Sorry, there are not enough "{book_title}" books in stock')
+
+
+def reserve_stock(cart_items):
+    """
+    Списывает остатки условным UPDATE (stock >= qty) по одному запросу на позицию.
+    Книги без учета остатков (stock IS NULL) проходят тем же UPDATE, NULL - qty остается NULL.
+    Позиции сортируются по book_id, чтобы параллельные заказы блокировали книги
+    в одном порядке. Вызывать внутри transaction.atomic - при нехватке весь заказ откатится.
+    """
+    for cart_item in sorted(cart_items, key=lambda cart_item: cart_item.book_id):
+        reserved = Book.objects.filter(
+            Q(stock__isnull=True) | Q(stock__gte=cart_item.qty), id=cart_item.book_id,
+        ).update(stock=F('stock') - cart_item.qty)
+        if not reserved:
+            raise OutOfStockError(cart_item.book.title)
+
+
 def save_checkout(instance, form):
-    checkout_model = form.save(commit=False)
-    checkout_model.cart = instance.cart
-    checkout_model.user_account = instance.account
-    checkout_model.save()
-    instance.cart.is_used = True
-    instance.cart.save()
+    with transaction.atomic():
+        reserve_stock(instance.cart.cart_items.select_related('book'))
+        checkout_model = form.save(commit=False)
+        checkout_model.cart = instance.cart
+        checkout_model.user_account = instance.account
+        checkout_model.save()
+        # скидка фиксируется по правилам на момент заказа и сохраняется вместе с корзиной
+        apply_current_discount(instance.cart)
+        create_checkout_snapshot(checkout_model)
+        add_checkout_to_stats(checkout_model)
+        instance.cart.is_used = True
+        instance.cart.save(update_fields=['is_used', 'discount', 'promotions_version'])
+    return checkout_model
+
+
+def create_checkout_snapshot(checkout):
+    """
+    Фиксирует названия, цены и итоги позиций корзины в заказе.
+    Цены берутся из позиций корзины, а не из текущей Book.price, скидка - сохраненная в корзине:
+    снимок совпадает с суммой, которую видел покупатель, и для старых заказов тоже
+    """
+    cart_items = checkout.cart.cart_items.select_related('book')
+    checkout_items = []
+    for cart_item in cart_items:
+        final_price = cart_item.final_price
+        if final_price is None:
+            final_price = cart_item.book.price * cart_item.qty
+        checkout_items.append(CheckoutItem(
+            checkout=checkout,
+            book=cart_item.book,
+            title=cart_item.book.title,
+            unit_price=final_price / cart_item.qty if cart_item.qty else final_price,
+            qty=cart_item.qty,
+            final_price=final_price,
+        ))
+    CheckoutItem.objects.bulk_create(checkout_items)
+    checkout.total_qty = sum(item.qty for item in checkout_items)
+    checkout.discount = checkout.cart.discount
+    checkout.total_price = sum(item.final_price for item in checkout_items) - checkout.discount
+    checkout.save(update_fields=['total_qty', 'discount', 'total_price'])
 
 
-def update_cart_item_quantity(id, cart, id_data):
-    if not id.startswith('csrf'):
-        cart_item = get_object_or_404(cart.cart_items, id=id)
-        cart_item.qty = int(id_data[id])
-        cart_item.save(update_fields=['qty',])
+def increment_or_create(model, lookup, increments, **fields):
+    """ UPDATE счетчиков через F(), если строки нет - INSERT (с повтором UPDATE при гонке) """
+    queryset = model.objects.filter(**lookup)
+    updates = {name: F(name) + value for name, value in increments.items()}
+    if queryset.update(**updates, **fields):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **increments, **fields)
+    except IntegrityError:
+        queryset.update(**updates, **fields)
+
+
+def add_checkout_to_stats(checkout):
+    increments = {'orders_count': 1, 'total_spent': checkout.total_price}
+    order_date = checkout.date_of_creation
+    increment_or_create(
+        UserAccountStats, {'user_account': checkout.user_account}, increments,
+        last_order_date=order_date)
+    increment_or_create(
+        UserAccountMonthlyStats,
+        {'user_account': checkout.user_account, 'month': order_date.replace(day=1)},
+        increments)
+
+
+def rebuild_order_stats():
+    """ Пересчитывает всю статистику заказов одним сгруппированным проходом """
+    checkouts = Checkout.objects.filter(total_price__isnull=False)
+    with transaction.atomic():
+        account_stats = [
+            UserAccountStats(
+                user_account_id=row['user_account'], orders_count=row['orders_count'],
+                total_spent=row['total_spent'], last_order_date=row['last_order_date'])
+            for row in checkouts.values('user_account').annotate(
+                orders_count=Count('id'), total_spent=Sum('total_price'),
+                last_order_date=Max('date_of_creation')).order_by()
+        ]
+        monthly_stats = [
+            UserAccountMonthlyStats(
+                user_account_id=row['user_account'], month=row['month'],
+                orders_count=row['orders_count'], total_spent=row['total_spent'])
+            for row in checkouts.annotate(month=TruncMonth('date_of_creation')).values(
+                'user_account', 'month').annotate(
+                orders_count=Count('id'), total_spent=Sum('total_price')).order_by()
+        ]
+        UserAccountStats.objects.all().delete()
+        UserAccountMonthlyStats.objects.all().delete()
+        UserAccountStats.objects.bulk_create(account_stats, batch_size=1000)
+        UserAccountMonthlyStats.objects.bulk_create(monthly_stats, batch_size=1000)
+    return len(account_stats), len(monthly_stats)
+
+
+# AccountView
+def get_account_stats(account):
+    return UserAccountStats.objects.filter(user_account=account).first()
+
+
+# RecalcCartView
+MAX_CART_ITEM_QTY = 20
+
+
+def parse_cart_quantities(data):
+    """ Валидирует все количества сразу, возвращает {cart_item_id: qty} и ошибки """
+    quantities = {}
+    errors = {}
+    for key, value in data.items():
+        if not key.isdigit():
+            continue
+        try:
+            qty = int(value)
+        except (TypeError, ValueError):
+            errors[key] = f'"{value}" is not a number'
+            continue
+        if not 0 <= qty <= MAX_CART_ITEM_QTY:
+            errors[key] = f'Qty must be between 0 and {MAX_CART_ITEM_QTY}, you gived: {qty}'
+            continue
+        quantities[int(key)] = qty
+    return quantities, errors
+
+
+def update_cart_items_quantities(cart, quantities):
+    """ Одним запросом загружает позиции, обновляет их bulk_update, нулевые удаляет """
+    if isinstance(cart, AnonymousCart):
+        cart.update_quantities(quantities)
+        return
+    cart_items = list(cart.cart_items.select_related('book').filter(id__in=quantities))
+    if len(cart_items) != len(quantities):
+        raise Http404('No CartItem matches the given query.')
+    items_to_delete = []
+    items_to_update = []
+    for cart_item in cart_items:
+        qty = quantities[cart_item.id]
+        if qty == 0:
+            items_to_delete.append(cart_item.id)
+        elif qty != cart_item.qty:
+            cart_item.qty = qty
+            cart_item.final_price = cart_item.book.price * qty
+            items_to_update.append(cart_item)
+    if not items_to_delete and not items_to_update:
+        return
+    with transaction.atomic():
+        if items_to_delete:
+            CartItem.objects.filter(id__in=items_to_delete).delete()
+        if items_to_update:
+            CartItem.objects.bulk_update(items_to_update, ['qty', 'final_price'])
+        recalc_cart_summary(cart)
+
+
+def cart_totals_json_responce(cart, errors):
+    if errors:
+        return JsonResponse({'status': 'form_invalid', 'errors': errors}, status=400)
+    return JsonResponse({'good': True, 'cart_info': {
+        'items_count': cart.items_count,
+        'total_qty': cart.total_qty,
+        'total_price': f'{cart.total_price:.2f}',
+        'discount': f'{cart.discount:.2f}',
+        'final_price': f'{cart.get_cart_result("final_price"):.2f}',
+    }}, status=200)
 
 # SearchView
 def get_filtered_by_slug_or_title_queryset(manager, data):
@@ -132,21 +454,159 @@ def get_search_results(data):
     return [category_queryset, book_queryset]
 
 
+# CartView
+def get_cart_products(instance):
+    if isinstance(instance.cart, AnonymousCart):
+        return instance.cart.get_cart_items()
+    return instance.cart.cart_items.select_related('book')
+
+
 # LoginView
-def authenticate_and_login_user(request, username, password, message_text):
-    user = authenticate(username=username, password=password)
-    if user:
-        login(request, user)
-        messages.add_message(request, messages.SUCCESS,
-                             mark_safe(message_text))
-        return True
-    else:
-        messages.add_message(request, messages.ERROR, 'You had not logged, wrong data')
-        return False
-        
+def login_user(request, user, message_text):
+    """ Вход уже проверенного пользователя (LoginForm, регистрация) без повторного хеширования пароля """
+    login(request, user, backend='django.contrib.auth.backends.ModelBackend')
+    messages.add_message(request, messages.SUCCESS,
+                         mark_safe(message_text))
+
+
+# LoginView, RegistrationView
+def merge_anonymous_cart(request, response):
+    """
+    Переносит корзину анонимного посетителя в корзину пользователя одной пачкой.
+    Если параллельный запрос успел добавить те же книги, их qty увеличивается, как в upsert_cart_item
+    """
+    anonymous_cart = AnonymousCart.from_request(request)
+    quantities = anonymous_cart.get_quantities()
+    if not quantities:
+        return
+    account, wishlist, cart = load_shopping_context(request)
+    with transaction.atomic():
+        cart_items = list(cart.cart_items.select_related('book').filter(book_id__in=quantities))
+        for cart_item in cart_items:
+            cart_item.qty += quantities.pop(cart_item.book_id)
+            cart_item.final_price = cart_item.book.price * cart_item.qty
+        CartItem.objects.bulk_update(cart_items, ['qty', 'final_price'])
+        books = list(Book.objects.filter(id__in=quantities))
+        try:
+            with transaction.atomic():
+                CartItem.objects.bulk_create([
+                    CartItem(book=book, cart=cart, qty=quantities[book.id],
+                             final_price=book.price * quantities[book.id])
+                    for book in books
+                ])
+        except IntegrityError:
+            for book in books:
+                try:
+                    with transaction.atomic():
+                        CartItem.objects.bulk_create([CartItem(
+                            book=book, cart=cart, qty=quantities[book.id],
+                            final_price=book.price * quantities[book.id])])
+                except IntegrityError:
+                    increment_cart_item_qty(cart, book, quantities[book.id])
+        recalc_cart_summary(cart)
+    anonymous_cart.clear()
+    anonymous_cart.save(response)
+
+
 # RegistrationView
 def register_user(form):
+    """
+    Создает пользователя, аккаунт, вишлист и открытую корзину одной транзакцией,
+    пароль хешируется один раз. Возвращает пользователя и id его объектов для сессии
+    """
     user_model = form.save(commit=False)
-    user_model.set_password(form.cleaned_data['password'])
-    user_model.save()
+    with transaction.atomic():
+        user_model.set_password(form.cleaned_data['password'])
+        user_model.save()
+        shopping_context = create_new_shopping_context(user_model, email=user_model.email)
+    return user_model, shopping_context
+
+
+def register_and_login_user(request, form, message_text):
+    """ Регистрация и вход без authenticate(), на следующем запросе UserMixin не создает объекты """
+    user_model, shopping_context = register_user(form)
+    login_user(request, user_model, message_text)
+    save_shopping_context(request, shopping_context)
     return user_model
+
+
+# provision_users command
+def provision_users(count, password, prefix='loadtest', batch_size=1000):
+    """
+    Создает пользователей для нагрузочных тестов пачками bulk_create вместе с аккаунтами,
+    вишлистами и корзинами. Хеш пароля считается один раз и общий для всех пользователей
+    """
+    password_hash = make_password(password)
+    default_avatar = get_default_avatar()
+    created_count = 0
+    for start in range(0, count, batch_size):
+        usernames = [f'{prefix}{i}' for i in range(start, min(start + batch_size, count))]
+        with transaction.atomic():
+            User.objects.bulk_create([
+                User(username=username, email=f'{username}@example.com', password=password_hash)
+                for username in usernames
+            ], ignore_conflicts=True)
+            # bulk_create на SQLite не возвращает id, поэтому перечитываем их
+            user_ids = list(User.objects.filter(
+                username__in=usernames, account__isnull=True).values_list('id', 'email'))
+            UserAccount.objects.bulk_create([
+                UserAccount(user_id=user_id, email=email, image=default_avatar)
+                for user_id, email in user_ids
+            ])
+            WishList.objects.bulk_create([WishList(user_id=user_id) for user_id, email in user_ids])
+            Cart.objects.bulk_create([Cart(user_id=user_id) for user_id, email in user_ids])
+        created_count += len(user_ids)
+    return created_count
+
+
+# BookAdmin, reprice_books command
+def get_prices_changed_by_percent(books, percent):
+    multiplier = (100 + Decimal(percent)) / 100
+    return {
+        book.id: (book.price * multiplier).quantize(Decimal('0.01'))
+        for book in books
+    }
+
+
+def reprice_books(new_prices, batch_size=500):
+    """
+    Массово меняет цены книг {book_id: price} пачками по batch_size.
+    Для каждой пачки в одной транзакции: bulk_update цен, запись истории цен,
+    один UPDATE final_price для позиций незакрытых корзин и один UPDATE итогов этих корзин.
+    Возвращает количество книг, у которых изменилась цена.
+    """
+    book_ids = list(new_prices)
+    repriced_count = 0
+    for start in range(0, len(book_ids), batch_size):
+        with transaction.atomic():
+            books = Book.objects.filter(
+                id__in=book_ids[start:start + batch_size]).only('id', 'price')
+            changed_books = []
+            price_history = []
+            for book in books:
+                new_price = new_prices[book.id]
+                if book.price == new_price:
+                    continue
+                price_history.append(BookPriceHistory(
+                    book=book, old_price=book.price, price=new_price))
+                book.price = new_price
+                changed_books.append(book)
+            if not changed_books:
+                continue
+            Book.objects.bulk_update(changed_books, ['price'])
+            BookPriceHistory.objects.bulk_create(price_history)
+            update_open_carts_prices([book.id for book in changed_books])
+            repriced_count += len(changed_books)
+    return repriced_count
+
+
+def update_open_carts_prices(book_ids):
+    open_cart_items = CartItem.objects.filter(
+        book_id__in=book_ids, cart__is_used=False)
+    open_cart_items.update(final_price=F('qty') * Subquery(
+        Book.objects.filter(id=OuterRef('book_id')).values('price')[:1]))
+    cart_total_price = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values(
+        'cart').annotate(total_price=Sum('final_price')).values('total_price')
+    # promotions_version сбрасывается, чтобы discount пересчитался при следующем чтении корзины
+    Cart.objects.filter(is_used=False, cart_items__book_id__in=book_ids).update(
+        total_price=Coalesce(Subquery(cart_total_price), Decimal('0')), promotions_version='')
@@ -0,0 +1,78 @@
+from django.db import transaction
+
+from bookapp.models import Cart, UserAccount, WishList
+
+
+SHOPPING_CONTEXT_SESSION_KEY = 'shopping_context'
+
+
+def create_shopping_context(user, **account_fields):
+    """
+    Создает аккаунт, вишлист и открытую корзину пользователя, если их еще нет.
+    Вызывается при регистрации, для старых пользователей - при первом запросе.
+    Возвращает id объектов для сессии
+    """
+    with transaction.atomic():
+        account, account_created = UserAccount.objects.get_or_create(
+            user=user, defaults=account_fields)
+        wishlist = WishList.objects.filter(user=user).order_by('id').first()
+        if wishlist is None:
+            wishlist = WishList.objects.create(user=user)
+        cart = Cart.objects.filter(user=user, is_used=False).order_by('id').first()
+        if cart is None:
+            cart = Cart.objects.create(user=user)
+    return {
+        'user_id': user.id,
+        'account_id': account.id,
+        'wishlist_id': wishlist.id,
+        'cart_id': cart.id,
+    }
+
+
+def create_new_shopping_context(user, **account_fields):
+    """ Для только что созданного пользователя: три INSERT без проверок существования """
+    account = UserAccount.objects.create(user=user, **account_fields)
+    wishlist = WishList.objects.create(user=user)
+    cart = Cart.objects.create(user=user)
+    return {
+        'user_id': user.id,
+        'account_id': account.id,
+        'wishlist_id': wishlist.id,
+        'cart_id': cart.id,
+    }
+
+
+def save_shopping_context(request, shopping_context):
+    request.session[SHOPPING_CONTEXT_SESSION_KEY] = shopping_context
+
+
+def get_open_cart_with_account(cart_id):
+    return Cart.objects.select_related('user__account').filter(id=cart_id, is_used=False).first()
+
+
+def load_shopping_context(request):
+    """
+    Возвращает (account, wishlist, cart) пользователя одним запросом: корзина с join на аккаунт,
+    вишлист собирается по id из сессии без запроса
+    """
+    user = request.user
+    shopping_context = request.session.get(SHOPPING_CONTEXT_SESSION_KEY)
+    cart = None
+    if shopping_context and shopping_context['user_id'] == user.id:
+        cart = get_open_cart_with_account(shopping_context['cart_id'])
+    if cart is None:
+        # контекста еще нет или корзину закрыли заказом в другой сессии
+        shopping_context = create_shopping_context(user)
+        save_shopping_context(request, shopping_context)
+        cart = get_open_cart_with_account(shopping_context['cart_id'])
+    wishlist = WishList(id=shopping_context['wishlist_id'], user_id=user.id)
+    return cart.user.account, wishlist, cart
+
+
+def open_new_cart(request):
+    """ Открывает новую корзину после заказа и обновляет контекст в сессии """
+    cart = Cart.objects.create(user=request.user)
+    shopping_context = request.session.get(SHOPPING_CONTEXT_SESSION_KEY)
+    if shopping_context:
+        request.session[SHOPPING_CONTEXT_SESSION_KEY] = {**shopping_context, 'cart_id': cart.id}
+    return cart
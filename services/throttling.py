@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.core.cache import cache
+
+import hashlib
+import math
+import time
+
+
+THROTTLE_KEY = 'throttle'
+THROTTLED_COUNTER_KEY = 'throttled'
+
+
+def get_client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def get_window(period, now=None):
+    """ Номер текущего окна и секунд от его начала """
+    now = time.time() if now is None else now
+    return int(now // period), now % period
+
+
+def get_throttle_key(scope, ident, window):
+    # username может содержать символы, недопустимые в ключах memcached
+    return f'{THROTTLE_KEY}:{scope}:{hashlib.md5(ident.encode()).hexdigest()}:{window}'
+
+
+def get_window_counts(scope, ident, window):
+    """ Счетчики предыдущего и текущего окна """
+    keys = [get_throttle_key(scope, ident, window - 1), get_throttle_key(scope, ident, window)]
+    counts = cache.get_many(keys)
+    return counts.get(keys[0], 0), counts.get(keys[1], 0)
+
+
+def take_token(scope, ident):
+    """
+    Скользящее окно в общем кеше: счетчик текущего окна плюс счетчик предыдущего
+    с весом доли, которая еще попадает в последние period секунд. В отличие от
+    фиксированного окна на границе окон не проходит 2 * capacity запросов.
+    Счетчик увеличивается атомарно (cache.add + cache.incr), параллельные запросы
+    с разных процессов не могут пропустить лишний запрос, как при get/set.
+    Отклоненный запрос счетчик возвращает обратно
+    """
+    capacity, period = settings.THROTTLE_RATES[scope]
+    window, elapsed = get_window(period)
+    key = get_throttle_key(scope, ident, window)
+    # счетчик нужен еще одно окно - как предыдущий
+    timeout = math.ceil(2 * period - elapsed)
+    cache.add(key, 0, timeout)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # счетчик вытеснили из кеша между add и incr
+        cache.set(key, 1, timeout)
+        count = 1
+    previous_count = cache.get(get_throttle_key(scope, ident, window - 1), 0) if count <= capacity else 0
+    if count <= capacity and previous_count * (period - elapsed) / period + count <= capacity:
+        return True
+    # отклоненный запрос не занимает место в окне, иначе клиент, который продолжает
+    # слать запросы, не дождался бы свободного места
+    try:
+        cache.decr(key)
+    except ValueError:
+        pass
+    return False
+
+
+def count_throttled(scope):
+    key = f'{THROTTLED_COUNTER_KEY}:{scope}'
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # счетчик вытеснили из кеша между add и incr
+        cache.set(key, 1, None)
+
+
+def get_blocking_scope(request, scope, username=None):
+    """
+    Проверяет бакет по ip, а для входа еще и бакет по username.
+    Возвращает (scope, ident) бакета, который отклонил запрос, или None
+    """
+    buckets = [(scope, get_client_ip(request))]
+    if username:
+        buckets.append((f'{scope}_username', username.lower()))
+    for bucket_scope, ident in buckets:
+        if not take_token(bucket_scope, ident):
+            count_throttled(bucket_scope)
+            return bucket_scope, ident
+    return None
+
+
+def get_retry_after(scope, ident):
+    """ Секунд до того, как следующий запрос пройдет, если других запросов не будет """
+    capacity, period = settings.THROTTLE_RATES[scope]
+    window, elapsed = get_window(period)
+    previous_count, count = get_window_counts(scope, ident, window)
+    if count < capacity:
+        # не пускает вес предыдущего окна: previous * (period - t) / period + count + 1 <= capacity
+        wait = period - (capacity - count - 1) * period / previous_count - elapsed if previous_count else 0
+    else:
+        # текущее окно станет предыдущим: count * (period - t) / period + 1 <= capacity
+        wait = period - elapsed + period - (capacity - 1) * period / count
+    return max(1, math.ceil(wait))
+
+
+def get_throttled_counts():
+    scopes = settings.THROTTLE_RATES
+    counts = cache.get_many([f'{THROTTLED_COUNTER_KEY}:{scope}' for scope in scopes])
+    return {scope: counts.get(f'{THROTTLED_COUNTER_KEY}:{scope}', 0) for scope in scopes}
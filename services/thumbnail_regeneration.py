@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import django
+import os
+import time
+
+from bookapp.models import Book, ThumbnailSource
+from services.thumbnails import (
+    FAILED, GENERATED, SKIPPED, get_renditions, get_thumbnails_key, get_thumbnails_spec_hash, regenerate_image)
+
+
+def get_image_names():
+    """ Обложки книг. Аватары приводятся к AVATAR_SIZE при загрузке, рендишены им не нужны """
+    # без order_by() в DISTINCT попал бы id из Book.Meta.ordering - по задаче на книгу, а не на файл
+    return sorted(Book.objects.exclude(image='').order_by().values_list('image', flat=True).distinct())
+
+
+def get_known_sources(spec_hash):
+    """ {name: (source_hash, size, mtime, failed)} изображений, уже обработанных с текущими размерами """
+    return {
+        name: (source_hash, size, mtime, failed)
+        for name, source_hash, size, mtime, failed in ThumbnailSource.objects.filter(spec_hash=spec_hash).values_list(
+            'name', 'source_hash', 'source_size', 'source_mtime', 'failed').iterator(chunk_size=10000)
+    }
+
+
+def save_known_sources(states, spec_hash):
+    with transaction.atomic():
+        ThumbnailSource.objects.filter(name__in=list(states)).delete()
+        ThumbnailSource.objects.bulk_create([
+            ThumbnailSource(name=name, source_hash=source_hash, source_size=size,
+                            source_mtime=mtime, failed=failed, spec_hash=spec_hash)
+            for name, (source_hash, size, mtime, failed) in states.items()
+        ])
+
+
+def regenerate_thumbnails(workers=None, batch_size=1000, force=False, progress=None):
+    """
+    Пересоздает рендишены Book.image в пуле процессов по числу ядер.
+    Изображения идут пачками по batch_size, после каждой пачки манифест (ThumbnailSource)
+    сохраняется, поэтому прерванный запуск продолжается с места остановки.
+    Процессы пула работают с тем же хранилищем, что и сайт (default_storage).
+    progress(counts, elapsed) вызывается после каждой пачки. Возвращает (counts, elapsed)
+    """
+    renditions = get_renditions()
+    spec_hash = get_thumbnails_spec_hash()
+    names = get_image_names()
+    known = {} if force else get_known_sources(spec_hash)
+    worker = partial(regenerate_image, default_storage, renditions, settings.THUMBNAIL_QUALITY)
+    workers = workers or os.cpu_count()
+
+    counts = Counter()
+    started = time.monotonic()
+    # django.setup нужен процессам, запущенным через spawn, при fork ничего не делает
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        for start in range(0, len(names), batch_size):
+            tasks = [(name, known.get(name)) for name in names[start:start + batch_size]]
+            changed = {}
+            for name, status, state in executor.map(
+                    worker, tasks, chunksize=max(1, len(tasks) // (workers * 4))):
+                counts[status] += 1
+                if status in (GENERATED, SKIPPED, FAILED) and state != known.get(name):
+                    changed[name] = state
+            save_known_sources(changed, spec_hash)
+            cache.delete_many([get_thumbnails_key(name) for name in changed])
+            if progress:
+                progress(counts, time.monotonic() - started)
+    return counts, time.monotonic() - started
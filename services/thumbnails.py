@@ -0,0 +1,214 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+
+import base64
+import hashlib
+import io
+import json
+
+from PIL import Image, ImageFilter, ImageOps
+
+
+THUMBNAILS_KEY = 'thumbnails'
+THUMBNAILS_TIMEOUT = 60 * 60 * 24
+# Нечитаемый оригинал не разбирается заново на каждом показе, но после замены файла
+# рендишены появятся не позже чем через этот интервал
+THUMBNAILS_FAILURE_TIMEOUT = 60 * 5
+THUMBNAILS_FAILED = 'failed'
+PLACEHOLDER_RENDITION = 'placeholder'
+PLACEHOLDER_WIDTH = 16
+
+
+def get_renditions():
+    """ {rendition: (width, height)}: размеры из THUMBNAIL_SIZES и их retina-версии name_2x """
+    scale = settings.THUMBNAIL_RETINA_SCALE
+    renditions = {}
+    for size_name, (width, height) in settings.THUMBNAIL_SIZES.items():
+        renditions[size_name] = (width, height)
+        renditions[f'{size_name}_{scale}x'] = (width * scale, height * scale)
+    return renditions
+
+
+def get_thumbnails_spec_hash():
+    """
+    Меняется вместе с настройками размеров, старые записи в кеше перестают читаться,
+    а рендишены получают новые имена
+    """
+    spec = [sorted(get_renditions().items()), settings.THUMBNAIL_QUALITY, PLACEHOLDER_WIDTH]
+    return hashlib.md5(json.dumps(spec).encode()).hexdigest()[:8]
+
+
+def get_thumbnail_name(name, rendition):
+    """
+    Рендишены лежат рядом с оригиналом: book.png -> book.png.card.1a2b3c4d.jpg.
+    Хеш настроек в имени: файл под таким именем не перезаписывается другим содержимым,
+    и у оригинала с именем по содержимому его URL тоже можно кешировать как immutable
+    """
+    return f'{name}.{rendition}.{get_thumbnails_spec_hash()}.jpg'
+
+
+def encode_jpeg(image, quality):
+    # progressive JPEG кодируется в разы дольше, а на рендишенах такого размера выигрыш в весе - единицы процентов
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def open_source_image(source, renditions):
+    """ Открывает оригинал с декодированием сразу в уменьшенном размере (draft для JPEG) """
+    image = Image.open(source)
+    image.draft('RGB', (max(width for width, height in renditions.values()),
+                        max(height for width, height in renditions.values())))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def fit_size(size, box):
+    """ Размер, вписанный в рамку box с сохранением пропорций, без увеличения """
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_thumbnails(source, renditions=None, quality=None):
+    """
+    {rendition: байты JPEG} для всех размеров и размытой заглушки.
+    renditions и quality передаются явно из процессов regenerate_thumbnails
+    """
+    renditions = renditions or get_renditions()
+    quality = quality or settings.THUMBNAIL_QUALITY
+    image = open_source_image(source, renditions)
+    thumbnails = {}
+    # от больших размеров к меньшим: каждый уменьшается из предыдущего, а не из оригинала,
+    # размер считается от оригинала, чтобы не накапливать ошибку округления
+    previous = image
+    for rendition, box in sorted(renditions.items(), key=lambda item: item[1], reverse=True):
+        size = fit_size(image.size, box)
+        base = previous if size[0] <= previous.size[0] and size[1] <= previous.size[1] else image
+        thumbnail = base.resize(size, Image.LANCZOS, reducing_gap=3.0) if size != base.size else base
+        thumbnails[rendition] = encode_jpeg(thumbnail, quality)
+        previous = thumbnail
+    placeholder = previous.copy()
+    placeholder.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 2))
+    thumbnails[PLACEHOLDER_RENDITION] = encode_jpeg(placeholder.filter(ImageFilter.GaussianBlur(1)), quality)
+    return thumbnails
+
+
+def save_thumbnails(storage, name, thumbnails):
+    for rendition, content in thumbnails.items():
+        thumbnail_name = get_thumbnail_name(name, rendition)
+        if hasattr(storage, 'save_derived'):
+            # хранилище по содержимому переименовало бы рендишен
+            storage.save_derived(thumbnail_name, ContentFile(content))
+            continue
+        if storage.exists(thumbnail_name):
+            storage.delete(thumbnail_name)
+        storage.save(thumbnail_name, ContentFile(content))
+
+
+def generate_thumbnails(image_file):
+    """ Создает рендишены файла ImageField, вызывается после загрузки нового изображения """
+    with image_file.storage.open(image_file.name) as source:
+        thumbnails = render_thumbnails(source)
+    save_thumbnails(image_file.storage, image_file.name, thumbnails)
+    cache.delete(get_thumbnails_key(image_file.name))
+    return thumbnails
+
+
+def get_thumbnails_key(name):
+    digest = hashlib.md5(name.encode()).hexdigest()
+    return f'{THUMBNAILS_KEY}:{get_thumbnails_spec_hash()}:{digest}'
+
+
+def get_placeholder_uri(content):
+    return 'data:image/jpeg;base64,' + base64.b64encode(content).decode()
+
+
+def load_thumbnails(image_file):
+    """
+    {'urls': {rendition: url}, 'placeholder': data URI}.
+    Для изображений, загруженных до появления рендишенов, они создаются при первом обращении
+    """
+    storage = image_file.storage
+    name = image_file.name
+    placeholder_name = get_thumbnail_name(name, PLACEHOLDER_RENDITION)
+    if all(storage.exists(get_thumbnail_name(name, rendition)) for rendition in get_renditions()) \
+            and storage.exists(placeholder_name):
+        with storage.open(placeholder_name) as placeholder:
+            placeholder_content = placeholder.read()
+    else:
+        placeholder_content = generate_thumbnails(image_file)[PLACEHOLDER_RENDITION]
+    return {
+        'urls': {rendition: storage.url(get_thumbnail_name(name, rendition)) for rendition in get_renditions()},
+        'placeholder': get_placeholder_uri(placeholder_content),
+    }
+
+
+def get_thumbnails(image_file):
+    """
+    Рендишены из кеша; если оригинал не читается, возвращает None и шаблон отдает оригинал.
+    Ошибка тоже кешируется, на THUMBNAILS_FAILURE_TIMEOUT
+    """
+    key = get_thumbnails_key(image_file.name)
+    thumbnails = cache.get(key)
+    if thumbnails is None:
+        try:
+            thumbnails = load_thumbnails(image_file)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            cache.set(key, THUMBNAILS_FAILED, THUMBNAILS_FAILURE_TIMEOUT)
+            return None
+        cache.set(key, thumbnails, THUMBNAILS_TIMEOUT)
+    if thumbnails == THUMBNAILS_FAILED:
+        return None
+    return thumbnails
+
+
+def refresh_thumbnails(image_file):
+    """ После загрузки: ошибка разбора не мешает сохранению, рендишены создадутся при первом показе """
+    try:
+        generate_thumbnails(image_file)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        cache.delete(get_thumbnails_key(image_file.name))
+
+
+# regenerate_thumbnails command
+GENERATED, SKIPPED, FAILED, MISSING = 'generated', 'skipped', 'failed', 'missing'
+
+
+def regenerate_image(storage, renditions, quality, task):
+    """
+    Выполняется в процессах пула, файлы читаются и пишутся через storage (DEFAULT_FILE_STORAGE).
+    task: (name, known), known - (source_hash, size, mtime, failed) из манифеста или None.
+    Файл не читается, если размер и mtime совпали с манифестом, и не перекодируется,
+    если совпал хеш содержимого. Нечитаемый оригинал запоминается с хешем
+    и не разбирается заново, пока не изменится. Возвращает (name, статус, новое состояние источника)
+    """
+    name, known = task
+    if not storage.exists(name):
+        return name, MISSING, None
+    size = storage.size(name)
+    mtime = storage.get_modified_time(name).timestamp()
+    thumbnail_names = [get_thumbnail_name(name, rendition) for rendition in [*renditions, PLACEHOLDER_RENDITION]]
+    if known and tuple(known[1:3]) == (size, mtime):
+        if known[3]:
+            return name, FAILED, known
+        if all(storage.exists(thumbnail_name) for thumbnail_name in thumbnail_names):
+            return name, SKIPPED, known
+
+    with storage.open(name) as source:
+        content = source.read()
+    source_hash = hashlib.md5(content).hexdigest()
+    if known and known[0] == source_hash:
+        if known[3]:
+            return name, FAILED, (source_hash, size, mtime, True)
+        if all(storage.exists(thumbnail_name) for thumbnail_name in thumbnail_names):
+            return name, SKIPPED, (source_hash, size, mtime, False)
+    try:
+        thumbnails = render_thumbnails(io.BytesIO(content), renditions, quality)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return name, FAILED, (source_hash, size, mtime, True)
+    save_thumbnails(storage, name, thumbnails)
+    return name, GENERATED, (source_hash, size, mtime, False)
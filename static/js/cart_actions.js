@@ -0,0 +1,53 @@
+// ссылки с data-ajax-action отправляются POST запросом, страница не перезагружается
+
+function update_header(result) {
+    let cart_info = result['cart_info'];
+    document.querySelector('.qty_items').innerText = `(${cart_info['items_count']} items)`;
+    document.querySelector('.summary_price').innerText = `${cart_info['final_price']} $`;
+    document.querySelector('.qty_notification').innerText = result['wishlist_info']['count'];
+}
+
+function show_messages(result) {
+    let messages_div = document.querySelector('.messages');
+    if (!messages_div) {
+        messages_div = document.createElement('div');
+        messages_div.className = 'messages';
+        document.querySelector('.search__section').after(messages_div);
+    }
+    messages_div.innerHTML = '';
+    for (let message of result['messages']) {
+        let message_div = document.createElement('div');
+        message_div.className = 'message_info';
+        message_div.innerText = message;
+        messages_div.append(message_div);
+    }
+}
+
+document.querySelectorAll('[data-ajax-action]').forEach(link => {
+    link.addEventListener('click', e => {
+        e.preventDefault();
+        fetch(link.href, {
+            method: 'POST',
+            headers: {
+                "X-Requested-With": "XMLHttpRequest",
+                "X-CSRFToken": document.querySelector('[name=csrfmiddlewaretoken]').value,
+            }
+        }).then(result => {
+            if (result.status == 401) {
+                window.location = link.href;
+            }
+            return result.json();
+        }).then(result => {
+            if (!result['good']) {
+                return;
+            }
+            update_header(result);
+            show_messages(result);
+            if (link.dataset.removeClosest) {
+                link.closest(link.dataset.removeClosest).remove();
+            } else if (link.dataset.ajaxAction == 'hide') {
+                link.remove();
+            }
+        })
+    })
+})